@@ -0,0 +1,442 @@
+"""发送性能基准测试：在本地启动 asyncio SMTP 接收端，用生成的 EPUB 文件驱动真实的发送流程
+
+不会连接 Gmail 或 QQ 邮箱。示例：
+
+    python bench_send.py                                  # 运行默认的一组场景，输出 JSON
+    python bench_send.py --files 50 --size-kb 500 --tls --auth --latency 0.01 --fail-rate 0.05
+    python bench_send.py --mode single --files 5 --size-kb 20000 --output bench.json
+
+结果包括 files/sec、MB/sec、峰值内存（RSS）以及服务器端看到的各阶段延迟（连接、TLS、认证、信封、DATA）。
+"""
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import random
+import shutil
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import send_files_to_kindle_via_email as kindle
+
+BENCH_PROVIDER = "Bench"
+BENCH_USERNAME = "bench@example.com"
+BENCH_PASSWORD = "bench-password"
+BENCH_KINDLE_EMAIL = "bench@kindle.com"
+
+
+def bench_recipients(count):
+    return ", ".join([BENCH_KINDLE_EMAIL] + [f"bench{n}@kindle.com" for n in range(1, count)])
+
+
+# 默认场景：(模式, 文件数, 单个文件大小 KB, 并行连接数, 每封邮件附件数上限, 是否 TLS)
+DEFAULT_SCENARIOS = [
+    ("single", 20, 200, 1, 1, False),
+    ("single", 3, 20000, 1, 1, False),
+    ("engine", 100, 100, 1, 1, False),
+    ("engine", 100, 100, 3, 1, False),
+    ("engine", 100, 100, 3, 25, False),
+    ("engine", 100, 100, 3, 25, True),
+]
+
+
+class SMTPSink:
+    """本地 SMTP 接收端：支持 STARTTLS、AUTH PLAIN/LOGIN、固定延迟和按概率注入的临时失败，收到的邮件只计数不保存
+
+    auth 为 False 时仍然提供 AUTH（程序总会登录），但接受任意用户名和密码。
+    refused_recipients 为 {地址: 回复}，RCPT 这些地址时返回指定的回复（例如 "550 no such user"）。
+    """
+
+    def __init__(self, tls_context=None, auth=False, latency=0.0, fail_rate=0.0, seed=0,
+                 refused_recipients=None):
+        self.tls_context = tls_context
+        self.refused_recipients = refused_recipients or {}
+        self.auth = auth
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.random = random.Random(seed)
+        self.messages = 0
+        self.bytes = 0
+        self.injected_failures = 0
+        self.phases = {"connect": [], "starttls": [], "auth": [], "envelope": [], "data": []}
+        self.port = None
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(ready,), name="SMTPSink", daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self.port
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._server.close)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def _run(self, ready):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, "127.0.0.1", 0))
+        self.port = self._server.sockets[0].getsockname()[1]
+        ready.set()
+        self._loop.run_forever()
+
+    async def _reply(self, writer, line):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        writer.write(line.encode("ascii") + b"\r\n")
+        await writer.drain()
+
+    async def _handle(self, reader, writer):
+        started = time.perf_counter()
+        greeted = False
+        authenticated = not self.auth
+        tls_active = False
+        envelope_started = None
+        try:
+            await self._reply(writer, "220 localhost bench sink")
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode("utf-8", errors="replace").strip()
+                verb = command.split(" ", 1)[0].upper()
+                if verb in ("EHLO", "HELO"):
+                    if not greeted:
+                        self.phases["connect"].append(time.perf_counter() - started)
+                        greeted = True
+                    capabilities = ["localhost", "SIZE 157286400", "8BITMIME"]
+                    if self.tls_context is not None and not tls_active:
+                        capabilities.append("STARTTLS")
+                    capabilities.append("AUTH PLAIN LOGIN")
+                    for capability in capabilities[:-1]:
+                        writer.write(f"250-{capability}\r\n".encode("ascii"))
+                    await self._reply(writer, f"250 {capabilities[-1]}")
+                elif verb == "STARTTLS" and self.tls_context is not None:
+                    tls_started = time.perf_counter()
+                    await self._reply(writer, "220 ready to start TLS")
+                    await writer.start_tls(self.tls_context)
+                    tls_active = True
+                    self.phases["starttls"].append(time.perf_counter() - tls_started)
+                elif verb == "AUTH":
+                    auth_started = time.perf_counter()
+                    authenticated = await self._authenticate(reader, writer, command)
+                    self.phases["auth"].append(time.perf_counter() - auth_started)
+                elif verb == "MAIL":
+                    if not authenticated:
+                        await self._reply(writer, "530 authentication required")
+                        continue
+                    envelope_started = time.perf_counter()
+                    await self._reply(writer, "250 sender ok")
+                elif verb == "RCPT":
+                    address = command[command.find("<") + 1:command.rfind(">")]
+                    await self._reply(writer, self.refused_recipients.get(address, "250 recipient ok"))
+                elif verb == "DATA":
+                    if envelope_started is not None:
+                        self.phases["envelope"].append(time.perf_counter() - envelope_started)
+                        envelope_started = None
+                    data_started = time.perf_counter()
+                    await self._reply(writer, "354 end data with <CR><LF>.<CR><LF>")
+                    size = await self._read_data(reader)
+                    if self.fail_rate and self.random.random() < self.fail_rate:
+                        self.injected_failures += 1
+                        await self._reply(writer, "451 4.3.0 injected temporary failure")
+                    else:
+                        self.messages += 1
+                        self.bytes += size
+                        await self._reply(writer, "250 queued")
+                    self.phases["data"].append(time.perf_counter() - data_started)
+                elif verb in ("RSET", "NOOP"):
+                    envelope_started = None
+                    await self._reply(writer, "250 ok")
+                elif verb == "QUIT":
+                    await self._reply(writer, "221 bye")
+                    break
+                else:
+                    await self._reply(writer, "502 command not implemented")
+        except (ConnectionError, asyncio.IncompleteReadError, ssl.SSLError):
+            pass
+        finally:
+            writer.close()
+
+    async def _authenticate(self, reader, writer, command):
+        parts = command.split()
+        mechanism = parts[1].upper() if len(parts) > 1 else ""
+        if mechanism == "PLAIN":
+            if len(parts) > 2:
+                token = parts[2]
+            else:
+                await self._reply(writer, "334 ")
+                token = (await reader.readline()).decode("ascii").strip()
+            _, username, password = base64.b64decode(token).decode("utf-8").split("\0")
+        elif mechanism == "LOGIN":
+            await self._reply(writer, "334 " + base64.b64encode(b"Username:").decode("ascii"))
+            username = base64.b64decode((await reader.readline()).strip()).decode("utf-8")
+            await self._reply(writer, "334 " + base64.b64encode(b"Password:").decode("ascii"))
+            password = base64.b64decode((await reader.readline()).strip()).decode("utf-8")
+        else:
+            await self._reply(writer, "504 unrecognized authentication type")
+            return False
+        if not self.auth or (username == BENCH_USERNAME and password == BENCH_PASSWORD):
+            await self._reply(writer, "235 authentication successful")
+            return True
+        await self._reply(writer, "535 authentication failed")
+        return False
+
+    @staticmethod
+    async def _read_data(reader):
+        """读取 DATA 内容直到 <CR><LF>.<CR><LF>，返回字节数（按块扫描，不逐行读取）"""
+        size = 0
+        tail = b"\r\n"
+        while True:
+            chunk = await reader.read(65536)
+            if not chunk:
+                raise asyncio.IncompleteReadError(tail, None)
+            window = tail + chunk
+            end = window.find(b"\r\n.\r\n")
+            if end >= 0:
+                # 结束标记之后的数据不会出现：客户端收到回复前不会发送下一条命令
+                return size + end + 2 - len(tail)
+            size += len(chunk)
+            tail = window[-4:]
+
+
+def make_tls_contexts(workdir):
+    """用 openssl 生成自签名证书，返回 (服务器端上下文, 信任该证书的客户端上下文)"""
+    cert = os.path.join(workdir, "cert.pem")
+    key = os.path.join(workdir, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key, "-out", cert,
+         "-days", "1", "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1"],
+        check=True, capture_output=True,
+    )
+    server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server_context.load_cert_chain(cert, key)
+    client_context = ssl.create_default_context(cafile=cert)
+    return server_context, client_context
+
+
+def generate_corpus(directory, count, size_kb, seed=0):
+    """生成 count 本约 size_kb KB 的 EPUB（随机内容不可压缩，结构能通过 is_valid_epub），返回总字节数"""
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    total = 0
+    for n in range(count):
+        path = os.path.join(directory, f"基准测试书籍_{n:05d}.epub")
+        with zipfile.ZipFile(path, "w") as book:
+            book.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip")
+            book.writestr("META-INF/container.xml",
+                          '<?xml version="1.0"?><container version="1.0" '
+                          'xmlns="urn:oasis:names:tc:opendocument:xmlns:container"><rootfiles>'
+                          '<rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+                          '</rootfiles></container>')
+            # 分块写入，生成大文件时不占用额外内存，峰值 RSS 只反映发送流程
+            with book.open("OEBPS/content.bin", "w", force_zip64=True) as payload:
+                for _ in range(size_kb):
+                    payload.write(rng.randbytes(1024))
+        total += os.path.getsize(path)
+    return total
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KB 为单位，macOS 以字节为单位
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def summarize_latencies(samples):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "p50_ms": ordered[len(ordered) // 2] * 1000,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def run_scenario(args):
+    """运行单个场景，返回结果字典"""
+    workdir = tempfile.mkdtemp(prefix="kindle-bench-")
+    try:
+        # 日志写到临时目录，避免污染程序目录下的 send_log.txt
+        root_logger = logging.getLogger()
+        for handler in list(root_logger.handlers):
+            root_logger.removeHandler(handler)
+        logging.basicConfig(filename=os.path.join(workdir, "bench_log.txt"), level=logging.INFO,
+                            format="%(asctime)s - %(levelname)s - %(message)s")
+
+        tls_context = None
+        if args.tls:
+            tls_context, kindle.SMTPSession.ssl_context = make_tls_contexts(workdir)
+        sink = SMTPSink(tls_context=tls_context, auth=args.auth, latency=args.latency, fail_rate=args.fail_rate,
+                        seed=args.seed)
+        port = sink.start()
+        kindle.SMTP_SERVERS[BENCH_PROVIDER] = ("localhost", port, "starttls" if args.tls else "none")
+
+        ebooks_dir = os.path.join(workdir, "Ebooks")
+        corpus_bytes = generate_corpus(ebooks_dir, args.files, args.size_kb, args.seed)
+        files = kindle.scan_ebooks(ebooks_dir)
+
+        started = time.perf_counter()
+        if args.mode == "single":
+            sent = failed = 0
+            session = kindle.SMTPSession(BENCH_PROVIDER, BENCH_USERNAME, BENCH_PASSWORD)
+            try:
+                for file in files:
+                    if kindle.send_to_kindle(os.path.join(ebooks_dir, file), BENCH_PROVIDER, BENCH_USERNAME, BENCH_PASSWORD,
+                                             bench_recipients(args.recipients), retries=args.retries,
+                                             delay=args.retry_delay, session=session):
+                        sent += 1
+                    else:
+                        failed += 1
+            finally:
+                session.close()
+        else:
+            limits = {
+                "messages_per_minute": 10 ** 9,
+                "bytes_per_minute": 10 ** 15,
+                "daily_quota": 10 ** 9,
+                "connections": args.connections,
+                "max_message_bytes": args.max_message_mb * 1024 * 1024,
+                "max_attachments": args.max_attachments,
+            }
+            index = kindle.FileIndex(os.path.join(workdir, "file_index.db"))
+            engine = kindle.SendEngine(
+                files, ebooks_dir, BENCH_PROVIDER, BENCH_USERNAME, BENCH_PASSWORD,
+                bench_recipients(args.recipients),
+                limits=limits, index=index, journal=kindle.SendJournal(os.path.join(workdir, "send_journal.jsonl")),
+                quota_path=os.path.join(workdir, "send_quota.json"),
+                retry_policy=kindle.RetryPolicy(max_attempts=args.retries, base_delay=args.retry_delay,
+                                                throttled_delay=args.retry_delay),
+            )
+            engine.run()
+            index.close()
+            sent, failed = engine.sent, engine.failed
+        elapsed = time.perf_counter() - started
+        sink.stop()
+
+        corpus_mb = corpus_bytes / (1024 * 1024)
+        return {
+            "mode": args.mode,
+            "files": args.files,
+            "size_kb": args.size_kb,
+            "connections": args.connections if args.mode == "engine" else 1,
+            "max_attachments": args.max_attachments if args.mode == "engine" else 1,
+            "recipients": args.recipients,
+            "tls": args.tls,
+            "auth": args.auth,
+            "latency_s": args.latency,
+            "fail_rate": args.fail_rate,
+            "sent": sent,
+            "failed": failed,
+            "messages": sink.messages,
+            "injected_failures": sink.injected_failures,
+            "elapsed_s": elapsed,
+            "files_per_s": sent / elapsed if elapsed else None,
+            "mb_per_s": corpus_mb * sent / args.files / elapsed if elapsed and args.files else None,
+            "wire_mb_per_s": sink.bytes / (1024 * 1024) / elapsed if elapsed else None,
+            "corpus_mb": corpus_mb,
+            "wire_mb": sink.bytes / (1024 * 1024),
+            "peak_rss_mb": peak_rss_mb(),
+            "phases": {name: summarize_latencies(samples) for name, samples in sink.phases.items()},
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def scenario_args(mode, files, size_kb, connections, max_attachments, tls):
+    args = ["--mode", mode, "--files", str(files), "--size-kb", str(size_kb),
+            "--connections", str(connections), "--max-attachments", str(max_attachments)]
+    if tls:
+        args.append("--tls")
+    return args
+
+
+def run_matrix(extra_args):
+    """每个场景在独立的子进程中运行，峰值内存互不影响"""
+    results = []
+    for scenario in DEFAULT_SCENARIOS:
+        command = [sys.executable, os.path.abspath(__file__), "--single-scenario", *scenario_args(*scenario), *extra_args]
+        completed = subprocess.run(command, check=True, capture_output=True, text=True)
+        result = json.loads(completed.stdout)
+        print(format_result(result), file=sys.stderr, flush=True)
+        results.append(result)
+    return results
+
+
+def format_result(result):
+    rss = f"{result['peak_rss_mb']:.1f} MB" if result["peak_rss_mb"] is not None else "n/a"
+    return (f"{result['mode']:6} files={result['files']:<5} size={result['size_kb']}KB conn={result['connections']} "
+            f"attach={result['max_attachments']} tls={'y' if result['tls'] else 'n'}: "
+            f"{result['files_per_s']:.1f} files/s, {result['mb_per_s']:.1f} MB/s, peak RSS {rss}, "
+            f"sent={result['sent']} failed={result['failed']} messages={result['messages']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="在本地 SMTP 接收端上测量发送流程的吞吐量、内存和各阶段延迟")
+    parser.add_argument("--mode", choices=("engine", "single"), default=None,
+                        help="engine：驱动 SendEngine（界面和监视模式使用的流程）；single：逐个调用 send_to_kindle。不指定时运行默认场景组")
+    parser.add_argument("--files", type=int, default=20, help="生成的书籍数量")
+    parser.add_argument("--size-kb", type=int, default=200, help="每本书的大小（KB）")
+    parser.add_argument("--connections", type=int, default=1, help="engine 模式的并行连接数")
+    parser.add_argument("--max-attachments", type=int, default=1, help="engine 模式每封邮件的附件数上限")
+    parser.add_argument("--max-message-mb", type=int, default=25, help="engine 模式每封邮件的大小上限（MB）")
+    parser.add_argument("--recipients", type=int, default=1, help="每本书的 Kindle 收件人数量")
+    parser.add_argument("--tls", action="store_true", help="启用 STARTTLS（需要 openssl 命令生成证书）")
+    parser.add_argument("--auth", action="store_true", help="要求 AUTH 认证")
+    parser.add_argument("--latency", type=float, default=0.0, help="接收端每条回复前的延迟（秒）")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="DATA 结束时返回 451 临时失败的概率")
+    parser.add_argument("--retries", type=int, default=3, help="每封邮件的最多尝试次数")
+    parser.add_argument("--retry-delay", type=float, default=0.05, help="重试退避的基数（秒）")
+    parser.add_argument("--seed", type=int, default=0, help="生成内容和注入失败使用的随机种子")
+    parser.add_argument("--output", help="把 JSON 结果写入文件（默认输出到标准输出）")
+    parser.add_argument("--single-scenario", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single_scenario or args.mode is not None:
+        if args.mode is None:
+            args.mode = "engine"
+        result = run_scenario(args)
+        if not args.single_scenario:
+            print(format_result(result), file=sys.stderr)
+        output = result
+    else:
+        extra = []
+        if args.auth:
+            extra.append("--auth")
+        extra += ["--recipients", str(args.recipients), "--latency", str(args.latency),
+                  "--fail-rate", str(args.fail_rate), "--retries", str(args.retries),
+                  "--retry-delay", str(args.retry_delay), "--seed", str(args.seed)]
+        output = run_matrix(extra)
+
+    text = json.dumps(output, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
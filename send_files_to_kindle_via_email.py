@@ -1,15 +1,28 @@
 import os
 import smtplib
+import socket
 import logging
+import logging.handlers
 import time
 import json
 import sys
-import tkinter as tk
-from tkinter import filedialog, messagebox, ttk
-from email.mime.multipart import MIMEMultipart
-from email.mime.application import MIMEApplication
+import re
+import uuid
+import heapq
+import collections
+import random
+import base64
+import io
+import queue
+import threading
+import posixpath
+from concurrent.futures import Future, ThreadPoolExecutor
+import select
+import argparse
 from email.utils import formatdate, make_msgid
 import hashlib
+import sqlite3
+import struct
 from email.header import Header
 from email import charset
 
@@ -32,24 +45,260 @@ DEFAULT_EBOOKS_DIR = os.path.join(BASE_DIR, "Ebooks")
 # 设置日志文件路径（相对路径）
 LOG_FILE = os.path.join(BASE_DIR, "send_log.txt")
 
+# 结构化事件日志（相对路径）：每行一个 JSON，记录各阶段耗时、字节数和 SMTP 回复码，不记录邮件内容
+EVENT_LOG_FILE = os.path.join(BASE_DIR, "send_events.jsonl")
+
+# 日志文件超过这个大小后轮转，保留的旧文件个数
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
+
 # 配置文件路径（相对路径）
 CONFIG_FILE = os.path.join(BASE_DIR, "config.json")
 
+# SMTP 服务器配置：(服务器, 端口, 加密方式)，加密方式为 starttls、ssl 或 none（仅限本地中继）
+SMTP_SERVERS = {
+    "Gmail": ("smtp.gmail.com", 587, "starttls"),
+    "QQ": ("smtp.qq.com", 465, "ssl"),
+}
+
+# 单个 SMTP 连接最多发送的邮件数，超过后回收连接（可在 config.json 中通过 max_messages_per_connection 修改）
+DEFAULT_MAX_MESSAGES_PER_CONNECTION = 50
+
+# 文件索引数据库（相对路径），缓存文件摘要、验证结果和发送记录
+INDEX_FILE = os.path.join(BASE_DIR, "file_index.db")
+
+# 发送日志文件（相对路径），记录批次内每个文件的状态，用于崩溃后恢复
+JOURNAL_FILE = os.path.join(BASE_DIR, "send_journal.jsonl")
+
+# 每日发送额度记录文件（相对路径）
+QUOTA_FILE = os.path.join(BASE_DIR, "send_quota.json")
+
+# 各邮箱提供商的默认限速：每分钟邮件数、每分钟字节数、24 小时内邮件数、并行连接数，
+# 以及合并发送时每封邮件的大小上限（编码后）和附件数上限（Kindle 每封邮件最多 25 个附件）
+# 可在 config.json 的 rate_limits 中按提供商覆盖，max_attachments 设为 1 即每本书单独发送
+PROVIDER_LIMITS = {
+    "Gmail": {
+        "messages_per_minute": 20,
+        "bytes_per_minute": 200 * 1024 * 1024,
+        "daily_quota": 500,
+        "connections": 3,
+        "max_message_bytes": 25 * 1024 * 1024,
+        "max_attachments": 25,
+    },
+    "QQ": {
+        "messages_per_minute": 10,
+        "bytes_per_minute": 100 * 1024 * 1024,
+        "daily_quota": 100,
+        "connections": 2,
+        "max_message_bytes": 50 * 1024 * 1024,
+        "max_attachments": 25,
+    },
+}
+
+# 发送失败的分类
+TRANSIENT = "transient"
+THROTTLED = "throttled"
+PERMANENT = "permanent"
+
+# 4xx 回复中表示限流的关键词（如 Gmail 的 "4.7.0 Try again later"）
+THROTTLE_PATTERN = re.compile(r"rate|limit|quota|too many|try again later|frequency|频率|过多", re.IGNORECASE)
+
+# 5xx 回复中表示额度用完的关键词（如 Gmail 的 "5.4.5 Daily user sending limit exceeded"）
+QUOTA_PATTERN = re.compile(r"quota|sending limit|rate limit|too many messages|频率", re.IGNORECASE)
+
+# 重试策略：每组文件最多尝试次数、临时故障和限流时的退避基数（秒）、最长退避时间（秒）
+RETRY_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 5
+RETRY_THROTTLED_DELAY = 60
+RETRY_MAX_DELAY = 900
+
+# 熔断器：连续失败多少次后暂停发送，以及初始和最长暂停时间（秒）
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_COOLDOWN = 60
+BREAKER_MAX_COOLDOWN = 900
+
+# 装箱时为每个附件的 MIME 头预留的字节数
+ATTACHMENT_OVERHEAD_BYTES = 1024
+
+# 附件流式编码时每次读取的字节数（57 的整数倍，正好编码成完整的 76 字符行）
+STREAM_CHUNK_SIZE = 57 * 1024
+
+# EPUB 压缩的结果缓存目录，按原文件的摘要和压缩选项命名，每本书只压缩一次（可随时删除）
+OPTIMIZE_CACHE_DIR = os.path.join(BASE_DIR, "epub_cache")
+
+# 发送前压缩 EPUB 的默认选项，可在 config.json 的 optimize_epub 中覆盖：
+# enabled 是否启用（也可用命令行 --optimize 开启），min_size 只压缩不小于该大小的文件，
+# max_image_side 把长边超过该像素数的图片缩小（需要安装 Pillow，0 表示不处理图片），jpeg_quality 为重新编码 JPEG 的质量，
+# strip_fonts 删除所有内嵌字体（默认只删除没有被任何样式或页面引用的字体）
+EPUB_OPTIMIZE_DEFAULTS = {
+    "enabled": False,
+    "min_size": 1024 * 1024,
+    "max_image_side": 1600,
+    "jpeg_quality": 85,
+    "strip_fonts": False,
+}
+
+# 压缩后至少变小这个比例才使用压缩结果
+OPTIMIZE_MIN_SAVING = 0.05
+
+# 压缩算法变化时递增，旧的缓存结果不再使用
+OPTIMIZE_VERSION = 3
+
+# 本身已经压缩过的图片格式，在 EPUB 中直接存储，不再 deflate
+STORED_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp")
+
+FONT_EXTENSIONS = (".ttf", ".otf", ".woff", ".woff2")
+
+# 样式表和页面中的资源引用：CSS 的 url(...) 以及 href/src 属性（值可能经过百分号编码）
+RESOURCE_REFERENCE = re.compile(rb'url\(\s*(?:"([^"]*)"|\'([^\']*)\'|([^"\')\s]+))'
+                                rb'|\b(?:href|src)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+# OPF 清单中的条目及其 href
+MANIFEST_ITEM = re.compile(rb'<item\b[^>]*\bhref\s*=\s*["\']([^"\']*)["\'][^>]*>\s*')
+
+# 可以在发送前转换为 EPUB 的文档格式（Markdown 不能直接发送，只有开启转换时才会被扫描）
+CONVERTIBLE_FORMATS = ("txt", "md", "markdown", "html", "htm")
+
+# 转换生成的 EPUB 缓存目录，按原文件的摘要、文件名和转换选项命名，没有改动的文档不会再次转换（可随时删除）
+CONVERT_CACHE_DIR = os.path.join(BASE_DIR, "converted_cache")
+
+# 文档转换的默认选项，可在 config.json 的 convert_documents 中覆盖：
+# enabled 是否启用（也可用命令行 --convert 开启），chapter_chars 为每个章节文件的最大字数（过长的章节拆成多个文件，
+# 没有章节标题的文档按这个长度分成若干部分）
+CONVERT_DEFAULTS = {
+    "enabled": False,
+    "chapter_chars": 50000,
+}
+
+# 转换算法变化时递增，旧的缓存结果不再使用
+CONVERT_VERSION = 1
+
+# 纯文本中的章节标题行：第X章/回/节/卷、Chapter N，以及序言、楔子、后记等
+CHAPTER_PATTERN = re.compile(
+    r"^(第\s*[0-9０-９零〇一二三四五六七八九十百千万两]+\s*[章回节卷集部篇](\s.*)?|(chapter|part|book)\s+([0-9]+|[ivxlc]+)\b.*"
+    r"|序章|序言|序|前言|引子|楔子|尾声|后记|番外.*)$",
+    re.IGNORECASE,
+)
+
+# 每个连接提前验证（计算摘要、检查文件结构）的邮件数，当前邮件上传时下一封已准备好
+PREFETCH_MESSAGES_PER_CONNECTION = 2
+
+# 监视模式：文件大小和修改时间保持不变多少秒后才认为已写完
+WATCH_SETTLE_SECONDS = 5
+
+# 监视模式：不支持 inotify 时轮询目录的间隔（秒）
+WATCH_POLL_INTERVAL = 10
+
+# 发送线程没有可取的文件、但其他连接仍在发送（失败后可能重新排队）时，每隔多少秒再查看一次
+WORKER_IDLE_POLL_INTERVAL = 0.5
+
+# 界面轮询后台发送事件的间隔（毫秒）
+EVENT_POLL_INTERVAL_MS = 100
+
+# 上传进度事件的最短间隔（秒），避免每写一块数据就刷新一次界面
+PROGRESS_UPDATE_INTERVAL = 0.5
+
+# 计算当前上传速度时使用最近多少秒的数据
+THROUGHPUT_WINDOW = 5
+
+# 输出不是终端（重定向到文件或日志）时，无界面模式打印上传进度的最短间隔（秒）
+HEADLESS_PROGRESS_INTERVAL = 10
+
+# 命令行退出码：全部成功、部分文件发送失败、参数或配置错误、无法连接或认证失败、发送中途被取消或停止
+EXIT_OK = 0
+EXIT_SEND_FAILED = 1
+EXIT_USAGE = 2
+EXIT_CONNECTION_FAILED = 3
+EXIT_CANCELLED = 4
+
+# 命令行模式下，config.json 中没有保存密码时从这个环境变量读取
+PASSWORD_ENV_VAR = "KINDLE_SENDER_PASSWORD"
+MISSING_ACCOUNT_MESSAGE = (f"缺少邮箱账号、密码或 Kindle 邮箱：请通过命令行参数指定，或先在图形界面中发送一次以保存配置"
+                           f"（密码也可以通过环境变量 {PASSWORD_ENV_VAR} 提供）。")
+
+# 已发送和发送失败的文件分别移入电子书目录下的这两个子目录
+SENT_DIR_NAME = "已发送至Kindle"
+FAILED_DIR_NAME = "发送失败"
+
+# Kindle 邮箱支持的格式：扩展名 -> MIME 类型
+KINDLE_FORMATS = {
+    "epub": "application/epub+zip",
+    "pdf": "application/pdf",
+    "doc": "application/msword",
+    "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "rtf": "application/rtf",
+    "txt": "text/plain",
+    "html": "text/html",
+    "htm": "text/html",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+    "gif": "image/gif",
+    "bmp": "image/bmp",
+}
+
+# 文件开头的魔数 -> 格式（"zip" 需要进一步区分 EPUB 和 DOCX，"bmp" 的魔数太短，还要检查文件头）
+FORMAT_MAGIC = (
+    (b"PK\x03\x04", "zip"),
+    (b"%PDF-", "pdf"),
+    (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "doc"),
+    (b"{\\rtf", "rtf"),
+    (b"\xff\xd8\xff", "jpg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"BM", "bmp"),
+)
+
+# ZIP 结构：本地文件头、中央目录文件头和目录结尾记录
+ZIP_LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+ZIP_CENTRAL_HEADER = struct.Struct("<4sHHHHHHIIIHHHHHII")
+ZIP_END_RECORD = struct.Struct("<4sHHHHIIH")
+# BMP 文件头：魔数、文件大小、保留字段、像素数据偏移和 DIB 头大小
+BMP_HEADER = struct.Struct("<2sIIII")
+BMP_DIB_HEADER_SIZES = (12, 40, 52, 56, 64, 108, 124)
+EPUB_MIMETYPE_ENTRY = b"mimetype"
+EPUB_MIMETYPE = b"application/epub+zip"
+
 # 设置 SentToKindle 和 FailedToSend 子目录
+def get_archive_dirs(ebooks_dir):
+    return os.path.join(ebooks_dir, SENT_DIR_NAME), os.path.join(ebooks_dir, FAILED_DIR_NAME)
+
 def setup_directories(ebooks_dir):
-    sent_dir = os.path.join(ebooks_dir, "已发送至Kindle")
-    failed_dir = os.path.join(ebooks_dir, "发送失败")
+    sent_dir, failed_dir = get_archive_dirs(ebooks_dir)
     for dir_path in [ebooks_dir, sent_dir, failed_dir]:
         if not os.path.exists(dir_path):
             os.makedirs(dir_path)
     return sent_dir, failed_dir
 
-# 日志配置
-logging.basicConfig(
-    filename=LOG_FILE,
-    level=logging.DEBUG,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)
+EVENT_LOGGER = logging.getLogger("kindle_sender.events")
+EVENT_LOGGER.propagate = False
+
+def setup_logging(level=logging.INFO):
+    """配置文本日志和结构化事件日志（都按大小轮转），由 main() 调用；作为模块导入时不写日志文件"""
+    handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                                                   encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    logging.basicConfig(level=level, handlers=[handler])
+    event_handler = logging.handlers.RotatingFileHandler(EVENT_LOG_FILE, maxBytes=LOG_MAX_BYTES,
+                                                         backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+    event_handler.setFormatter(logging.Formatter("%(message)s"))
+    EVENT_LOGGER.addHandler(event_handler)
+    EVENT_LOGGER.setLevel(logging.INFO)
+
+def log_event(event, **fields):
+    """向事件日志写一行 JSON：time、event 和调用方给出的字段（耗时以秒为单位）；未调用 setup_logging 时不写"""
+    if not EVENT_LOGGER.handlers:
+        return
+    record = {"time": round(time.time(), 3), "event": event}
+    for key, value in fields.items():
+        record[key] = round(value, 4) if isinstance(value, float) else value
+    EVENT_LOGGER.info(json.dumps(record, ensure_ascii=False))
+
+def import_tkinter():
+    """按需导入 tkinter：命令行和监视模式不需要图形界面，在没有显示器或未安装 Tk 的机器上也能运行"""
+    global tk, filedialog, messagebox, ttk
+    import tkinter as tk
+    from tkinter import filedialog, messagebox, ttk
 
 def load_config():
     """加载保存的配置，如果文件不存在或损坏，返回 None"""
@@ -88,6 +337,9 @@ def save_config(config):
             config["qq_username"] = existing_config.get("qq_username", "")
         if "qq_password" not in config:
             config["qq_password"] = existing_config.get("qq_password", "")
+        # 保留界面上没有的其他配置项（如 max_messages_per_connection）
+        for key, value in existing_config.items():
+            config.setdefault(key, value)
 
         with open(CONFIG_FILE, "w") as f:
             json.dump(config, f, indent=4)
@@ -99,11 +351,9 @@ def save_config(config):
             f"Error details: {e}"
         )
         logging.error(error_msg)
-        messagebox.showerror("错误", error_msg)
-        raise
+        raise PermissionError(error_msg) from e
     except Exception as e:
         logging.error(f"Failed to save config file: {e}")
-        messagebox.showerror("错误", f"无法保存配置：{e}")
         raise
 
 def clean_password(password):
@@ -118,34 +368,192 @@ def clean_password(password):
         logging.info("Detected potential Gmail App Password with spaces, removed spaces.")
     return cleaned
 
-def test_smtp_connection(email_provider, email_username, email_password, retries=3, delay=5):
-    """测试 SMTP 连接，支持重试机制，并提供详细的错误信息"""
-    # 清理密码
-    email_password = clean_password(email_password)
-    for attempt in range(retries):
+def get_smtp_server(email_provider):
+    """返回邮箱提供商对应的 (服务器, 端口, 加密方式)，未知提供商按 QQ 邮箱处理"""
+    return SMTP_SERVERS.get(email_provider, SMTP_SERVERS["QQ"])
+
+class SMTPSession:
+    """可复用的 SMTP 会话：整批文件共用一次连接和登录，断线自动重连，发送指定数量邮件后回收连接"""
+
+    # TLS 使用的 ssl.SSLContext，None 表示系统默认（自建或本地测试服务器可替换为信任其证书的上下文）
+    ssl_context = None
+
+    def __init__(self, email_provider, email_username, email_password,
+                 max_messages=DEFAULT_MAX_MESSAGES_PER_CONNECTION, timeout=60, smtp_server=None):
+        self.email_provider = email_provider
+        self.email_username = email_username
+        self.email_password = clean_password(email_password)
+        # (服务器, 端口, 加密方式)，不指定时按提供商查 SMTP_SERVERS
+        self.smtp_server = smtp_server or get_smtp_server(email_provider)
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self.server = None
+        self.sent_count = 0
+
+    def connect(self):
+        """建立新连接（TLS + 登录），已有连接会先关闭"""
+        self.close()
+        smtp_server, smtp_port, tls_mode = self.smtp_server
+        timings = {"connect": None, "tls": None, "auth": None}
+        phase_started = time.perf_counter()
+        server = None
         try:
-            if email_provider == "Gmail":
-                smtp_server = "smtp.gmail.com"
-                smtp_port = 587
-                server = smtplib.SMTP(smtp_server, smtp_port, timeout=60)
-                server.ehlo()
-                server.starttls()
+            if tls_mode == "ssl":
+                # SSL 连接的握手包含在建立连接中
+                server = smtplib.SMTP_SSL(smtp_server, smtp_port, timeout=self.timeout, context=self.ssl_context)
                 server.ehlo()
             else:
-                smtp_server = "smtp.qq.com"
-                smtp_port = 465
-                server = smtplib.SMTP_SSL(smtp_server, smtp_port, timeout=60)
+                server = smtplib.SMTP(smtp_server, smtp_port, timeout=self.timeout)
                 server.ehlo()
-            
-            server.login(email_username, email_password)
-            server.quit()
+                if tls_mode == "starttls":
+                    timings["connect"] = time.perf_counter() - phase_started
+                    phase_started = time.perf_counter()
+                    server.starttls(context=self.ssl_context)
+                    server.ehlo()
+                    timings["tls"] = time.perf_counter() - phase_started
+                    phase_started = time.perf_counter()
+            if timings["connect"] is None:
+                timings["connect"] = time.perf_counter() - phase_started
+                phase_started = time.perf_counter()
+            # DATA 由程序自行分块发送，关闭 Nagle 算法，避免小块（邮件头、结束标记）等待对方的延迟确认
+            server.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            code, _ = server.login(self.email_username, self.email_password)
+            timings["auth"] = time.perf_counter() - phase_started
+        except Exception as e:
+            if server is not None:
+                server.close()
+            log_event("connect_failed", host=smtp_server, port=smtp_port, tls=tls_mode, user=self.email_username,
+                      error=type(e).__name__, code=getattr(e, "smtp_code", None))
+            raise
+        self.server = server
+        self.sent_count = 0
+        logging.info(f"SMTP session opened: {smtp_server}:{smtp_port} as {self.email_username}")
+        log_event("connect", host=smtp_server, port=smtp_port, tls=tls_mode, user=self.email_username, code=code,
+                  connect_s=timings["connect"], tls_s=timings["tls"], auth_s=timings["auth"])
+        return server
+
+    def ensure_connected(self):
+        """返回可用的连接；未连接或已达到回收阈值时重新连接"""
+        if self.server is not None and self.max_messages and self.sent_count >= self.max_messages:
+            logging.info(f"Recycling SMTP connection after {self.sent_count} messages.")
+            self.close()
+        if self.server is None:
+            self.connect()
+        return self.server
+
+    def send_message(self, message, on_progress=None):
+        """把 StreamingMessage 分块写入 DATA，服务器断开时自动重连并重发一次
+
+        返回被拒收的收件人 {地址: (代码, 回复)}；所有收件人都被拒收时抛出 SMTPRecipientsRefused。
+        on_progress(字节数) 在每块数据写入网络后调用，用于统计上传进度。
+        """
+        server = self.ensure_connected()
+        try:
+            refused = self._transmit(server, message, on_progress)
+        except smtplib.SMTPServerDisconnected as e:
+            logging.warning(f"SMTP server disconnected, reconnecting: {e}")
+            self.close()
+            server = self.connect()
+            refused = self._transmit(server, message, on_progress)
+        self.sent_count += 1
+        return refused
+
+    @staticmethod
+    def _transmit(server, message, on_progress=None):
+        started = time.perf_counter()
+        options = [f"SIZE={message.size}"] if server.does_esmtp and server.has_extn("size") else []
+        code, resp = server.mail(message.from_addr, options)
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, resp, message.from_addr)
+        refused = {}
+        for to_addr in message.to_addrs:
+            code, resp = server.rcpt(to_addr)
+            if code not in (250, 251):
+                refused[to_addr] = (code, resp)
+        if len(refused) == len(message.to_addrs):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        code, resp = server.docmd("data")
+        if code != 354:
+            raise smtplib.SMTPDataError(code, resp)
+        envelope_s = time.perf_counter() - started
+        # 分别统计读文件加 base64 编码的时间和写入网络的时间
+        encode_s = data_s = 0.0
+        last = b""
+        chunks = message.iter_chunks()
+        while True:
+            phase_started = time.perf_counter()
+            chunk = next(chunks, None)
+            encode_s += time.perf_counter() - phase_started
+            if chunk is None:
+                break
+            if last:
+                phase_started = time.perf_counter()
+                server.sock.sendall(last)
+                data_s += time.perf_counter() - phase_started
+                if on_progress is not None:
+                    on_progress(len(last))
+            last = chunk
+        phase_started = time.perf_counter()
+        # 最后一块（邮件结尾的分隔行）和结束标记合并发送
+        server.sock.sendall(last + b".\r\n")
+        if on_progress is not None:
+            on_progress(len(last) + 3)
+        code, resp = server.getreply()
+        data_s += time.perf_counter() - phase_started
+        log_event("message", files=message.filenames, bytes=message.size, recipients=len(message.to_addrs),
+                  refused={address: reply[0] for address, reply in refused.items()}, code=code,
+                  envelope_s=envelope_s, encode_s=encode_s, data_s=data_s)
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    def reset(self):
+        """发送失败后重置会话状态，连接不可用时直接关闭，下次发送会重新连接"""
+        if self.server is None:
+            return
+        try:
+            self.server.rset()
+        except Exception:
+            self.close()
+
+    def close(self):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except Exception:
+            try:
+                self.server.close()
+            except Exception:
+                pass
+        self.server = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def check_smtp_connection(email_provider, email_username, email_password, retries=3, delay=5, session=None):
+    """测试 SMTP 连接，支持重试机制，返回 (是否成功, 失败时的详细错误信息)，不涉及界面，可在后台线程调用
+
+    传入 session 时，测试成功后连接保持打开并交给该会话继续用于发送。
+    """
+    own_session = session is None
+    if own_session:
+        session = SMTPSession(email_provider, email_username, email_password)
+    smtp_server, smtp_port, _ = session.smtp_server
+    for attempt in range(retries):
+        try:
+            session.connect()
+            if own_session:
+                session.close()
             logging.info("SMTP connection test successful.")
-            return True
+            return True, None
         except smtplib.SMTPAuthenticationError as e:
             logging.error(f"SMTP authentication failed: {e}")
             if email_provider == "Gmail":
-                messagebox.showerror(
-                    "错误",
+                return False, (
                     "Gmail SMTP 认证失败。\n"
                     "请确保：\n"
                     "1. 已启用两步验证（在 Google 账户设置中）。\n"
@@ -155,23 +563,19 @@ def test_smtp_connection(email_provider, email_username, email_password, retries
                     "- 登录 Google 账户 > 安全性 > 两步验证 > 应用专用密码 > 生成新密码。\n"
                     f"错误详情：{e}"
                 )
-            else:
-                messagebox.showerror(
-                    "错误",
-                    "QQ 邮箱 SMTP 认证失败。\n"
-                    "请确保：\n"
-                    "1. 使用的是授权码，而不是账户密码。\n"
-                    "2. 复制授权码时不要包含空格。\n"
-                    "如何获取授权码：\n"
-                    "- 登录 QQ 邮箱 > 设置 > 账户 > POP3/SMTP 服务 > 开启服务并生成授权码。\n"
-                    f"错误详情：{e}"
-                )
-            return False
+            return False, (
+                "QQ 邮箱 SMTP 认证失败。\n"
+                "请确保：\n"
+                "1. 使用的是授权码，而不是账户密码。\n"
+                "2. 复制授权码时不要包含空格。\n"
+                "如何获取授权码：\n"
+                "- 登录 QQ 邮箱 > 设置 > 账户 > POP3/SMTP 服务 > 开启服务并生成授权码。\n"
+                f"错误详情：{e}"
+            )
         except smtplib.SMTPConnectError as e:
             logging.error(f"SMTP connection error (attempt {attempt + 1}/{retries}): {e}")
             if attempt == retries - 1:
-                messagebox.showerror(
-                    "错误",
+                return False, (
                     f"无法连接到 {email_provider} SMTP 服务器。\n"
                     f"服务器：{smtp_server}:{smtp_port}\n"
                     "请检查：\n"
@@ -180,135 +584,2646 @@ def test_smtp_connection(email_provider, email_username, email_password, retries
                     "3. DNS 是否能正确解析（尝试运行 'ping smtp.gmail.com'）。\n"
                     f"错误详情：{e}"
                 )
-                return False
             time.sleep(delay)
         except smtplib.SMTPServerDisconnected as e:
             logging.error(f"SMTP server disconnected (attempt {attempt + 1}/{retries}): {e}")
             if attempt == retries - 1:
-                messagebox.showerror(
-                    "错误",
+                return False, (
                     f"{email_provider} SMTP 服务器断开连接。\n"
                     "请检查：\n"
                     "1. 网络是否稳定。\n"
                     "2. SMTP 配置是否正确。\n"
                     f"错误详情：{e}"
                 )
-                return False
             time.sleep(delay)
         except Exception as e:
             logging.error(f"SMTP connection failed (attempt {attempt + 1}/{retries}): {e}")
             if attempt == retries - 1:
-                messagebox.showerror(
-                    "错误",
+                return False, (
                     f"SMTP 连接失败。\n"
                     f"请检查网络、用户名和密码/授权码是否正确。\n"
                     f"错误详情：{e}"
                 )
-                return False
             time.sleep(delay)
-    return False
+    return False, "SMTP 连接失败。"
 
 def is_valid_epub(epub_path):
-    """验证文件是否为有效的 EPUB 文件（检查文件是否以 ZIP 格式开头并验证文件完整性）"""
+    """验证文件是否为有效的 EPUB 文件（只读取 ZIP 目录结尾记录和开头的 mimetype 条目，不读取整个文件）"""
     try:
         with open(epub_path, "rb") as f:
-            magic = f.read(2)
-            if magic != b"PK":
+            if not _check_zip_structure(f):
                 return False
             f.seek(0)
-            hasher = hashlib.sha256()
-            while chunk := f.read(8192):
-                hasher.update(chunk)
-            file_hash = hasher.hexdigest()
-            logging.info(f"File {epub_path} hash: {file_hash}")
-        return True
+            header = f.read(ZIP_LOCAL_HEADER.size + len(EPUB_MIMETYPE_ENTRY) + len(EPUB_MIMETYPE))
+            if _first_zip_entry_is_epub_mimetype(header):
+                return True
+            # 不规范的 EPUB：mimetype 不是第一个条目，退而在中央目录中查找
+            names = _read_zip_names(f)
+            return b"mimetype" in names and b"META-INF/container.xml" in names
     except Exception as e:
         logging.error(f"Failed to validate EPUB file {epub_path}: {e}")
         return False
 
-def send_to_kindle(epub_path, email_provider, email_username, email_password, kindle_email, retries=3, delay=5):
-    """发送电子书到 Kindle，支持重试机制"""
-    # 清理密码
-    email_password = clean_password(email_password)
-    for attempt in range(retries):
+def _first_zip_entry_is_epub_mimetype(header):
+    if len(header) < ZIP_LOCAL_HEADER.size:
+        return False
+    fields = ZIP_LOCAL_HEADER.unpack_from(header)
+    signature, method, name_len, extra_len = fields[0], fields[3], fields[9], fields[10]
+    if signature != b"PK\x03\x04" or method != 0 or extra_len != 0:
+        return False
+    name_end = ZIP_LOCAL_HEADER.size + name_len
+    return header[ZIP_LOCAL_HEADER.size:name_end] == EPUB_MIMETYPE_ENTRY and header[name_end:].startswith(EPUB_MIMETYPE)
+
+def _find_zip_end_record(f):
+    """返回 (目录结尾记录在文件中的偏移, 记录内容)，找不到（如文件被截断）时返回 (None, None)"""
+    size = f.seek(0, os.SEEK_END)
+    tail_size = min(size, ZIP_END_RECORD.size + 65535)
+    f.seek(size - tail_size)
+    tail = f.read(tail_size)
+    pos = tail.rfind(b"PK\x05\x06")
+    if pos < 0 or pos + ZIP_END_RECORD.size > len(tail):
+        return None, None
+    return size - tail_size + pos, ZIP_END_RECORD.unpack_from(tail, pos)
+
+def _check_zip_structure(f):
+    """检查 ZIP 目录结尾记录是否完整、中央目录是否落在文件范围内"""
+    f.seek(0)
+    if f.read(4) != b"PK\x03\x04":
+        return False
+    end_offset, record = _find_zip_end_record(f)
+    if record is None:
+        return False
+    entries, cd_size, cd_offset = record[4], record[5], record[6]
+    if cd_offset == 0xFFFFFFFF or entries == 0xFFFF:
+        # ZIP64，目录位置在 ZIP64 记录中，这里只确认结构存在
+        return True
+    return entries > 0 and cd_offset + cd_size <= end_offset
+
+def _read_zip_names(f):
+    """读取中央目录中的全部文件名"""
+    _, record = _find_zip_end_record(f)
+    cd_size, cd_offset = record[5], record[6]
+    f.seek(cd_offset)
+    directory = f.read(cd_size)
+    names = set()
+    pos = 0
+    while pos + ZIP_CENTRAL_HEADER.size <= len(directory):
+        fields = ZIP_CENTRAL_HEADER.unpack_from(directory, pos)
+        if fields[0] != b"PK\x01\x02":
+            break
+        name_len, extra_len, comment_len = fields[10], fields[11], fields[12]
+        start = pos + ZIP_CENTRAL_HEADER.size
+        names.add(directory[start:start + name_len])
+        pos = start + name_len + extra_len + comment_len
+    return names
+
+def detect_format(file_path):
+    """根据文件开头的魔数判断格式，返回 KINDLE_FORMATS 中的扩展名，无法识别时返回 None"""
+    with open(file_path, "rb") as f:
+        header = f.read(4096)
+        size = os.fstat(f.fileno()).st_size
+    ext = os.path.splitext(file_path)[1].lower().lstrip(".")
+    for magic, file_format in FORMAT_MAGIC:
+        if header.startswith(magic):
+            if file_format == "bmp" and not _is_bmp_header(header, size):
+                # 以“BM”开头的文本文件等
+                continue
+            if file_format == "zip":
+                if _first_zip_entry_is_epub_mimetype(header):
+                    return "epub"
+                if b"word/" in header or ext == "docx":
+                    return "docx"
+                return "epub" if ext == "epub" else None
+            if file_format == "jpg" and ext == "jpeg":
+                return "jpeg"
+            return file_format
+    # 纯文本、Markdown 和 HTML 没有魔数，按扩展名判断，并排除二进制内容（Markdown 需要先转换为 EPUB 才能发送）；
+    # 带 BOM 的 UTF-16 文本本身含有大量 \x00，不按二进制处理
+    if ext in CONVERTIBLE_FORMATS and (b"\x00" not in header or header.startswith((b"\xff\xfe", b"\xfe\xff"))):
+        return ext
+    return None
+
+def _is_bmp_header(header, size):
+    """检查 BMP 文件头：记录的文件大小与实际一致，DIB 头大小是已知的取值"""
+    if len(header) < BMP_HEADER.size:
+        return False
+    _, file_size, _, pixel_offset, dib_size = BMP_HEADER.unpack_from(header)
+    return file_size == size and dib_size in BMP_DIB_HEADER_SIZES and pixel_offset < size
+
+def check_ebook(file_path):
+    """识别文件格式并做低成本的结构检查，返回格式（KINDLE_FORMATS 的键），无效时返回 None"""
+    try:
+        file_format = detect_format(file_path)
+        if file_format == "epub":
+            return file_format if is_valid_epub(file_path) else None
+        if file_format == "docx":
+            with open(file_path, "rb") as f:
+                return file_format if _check_zip_structure(f) else None
+        if file_format == "pdf":
+            # 截断的 PDF 末尾没有 %%EOF
+            with open(file_path, "rb") as f:
+                size = f.seek(0, os.SEEK_END)
+                f.seek(max(0, size - 1024))
+                return file_format if b"%%EOF" in f.read() else None
+        return file_format
+    except Exception as e:
+        logging.error(f"Failed to validate file {file_path}: {e}")
+        return None
+
+def inspect_ebook(file_path):
+    """验证文件并计算 SHA-256 摘要，返回 (格式, 摘要)，无效文件返回 (None, None) 且不读取全文"""
+    file_format = check_ebook(file_path)
+    if file_format is None:
+        return None, None
+    try:
+        with open(file_path, "rb") as f:
+            hasher = hashlib.sha256()
+            while chunk := f.read(65536):
+                hasher.update(chunk)
+        file_hash = hasher.hexdigest()
+        logging.info(f"File {file_path} hash: {file_hash}")
+        return file_format, file_hash
+    except Exception as e:
+        logging.error(f"Failed to hash file {file_path}: {e}")
+        return None, None
+
+def scan_ebooks(ebooks_dir, convert=False):
+    """递归扫描电子书目录（跳过已发送和发送失败目录），返回按路径排序的相对路径列表
+
+    只按扩展名筛选，不读取文件内容；格式和完整性在发送前由 check_ebook 检查。convert 为 True 时也包括 Markdown 文档。
+    """
+    started = time.perf_counter()
+    files = sorted(os.path.relpath(entry.path, ebooks_dir) for entry in walk_ebooks(ebooks_dir, convert))
+    log_event("scan", dir=ebooks_dir, files=len(files), seconds=time.perf_counter() - started)
+    return files
+
+def walk_ebooks(ebooks_dir, convert=False, directories=None):
+    """递归遍历电子书目录（跳过已发送和发送失败目录及隐藏文件），逐个返回支持的文件的 os.DirEntry
+
+    传入 directories（列表）时把遍历到的目录（包括 ebooks_dir 本身）追加进去，供监视模式使用。
+    """
+    skip_dirs = {os.path.normcase(os.path.abspath(d)) for d in get_archive_dirs(ebooks_dir)}
+    log_file = os.path.normcase(os.path.abspath(LOG_FILE))
+    stack = [ebooks_dir]
+    while stack:
+        directory = stack.pop()
         try:
-            if not is_valid_epub(epub_path):
-                logging.error(f"Invalid EPUB file: {epub_path}")
-                return False
+            entries = list(os.scandir(directory))
+        except OSError as e:
+            logging.error(f"Failed to scan {directory}: {e}")
+            continue
+        if directories is not None:
+            directories.append(directory)
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if os.path.normcase(os.path.abspath(entry.path)) not in skip_dirs:
+                    stack.append(entry.path)
+            elif entry.is_file() and is_supported_file(entry.name, convert):
+                if os.path.normcase(os.path.abspath(entry.path)) != log_file:
+                    yield entry
 
-            filename = os.path.basename(epub_path)
-            book_name = os.path.splitext(filename)[0]
-            logging.info(f"Extracted book name: {book_name} from file: {filename}")
-
-            msg = MIMEMultipart()
-            msg["From"] = email_username
-            msg["To"] = kindle_email
-            # 设置邮件主题为书名（去掉扩展名后的文件名）
-            subject_header = Header(book_name, "utf-8")
-            msg["Subject"] = subject_header.encode(maxlinelen=76, linesep="\r\n")
-            msg["Date"] = formatdate(localtime=True)
-            msg["Message-ID"] = make_msgid()
-
-            with open(epub_path, "rb") as attachment:
-                part = MIMEApplication(
-                    attachment.read(),
-                    _subtype="epub+zip"
-                )
+def is_supported_file(name, convert=False):
+    ext = os.path.splitext(name)[1].lower().lstrip(".")
+    return ext in KINDLE_FORMATS or (convert and ext in CONVERTIBLE_FORMATS)
 
-            # 使用 Header 明确指定 quoted-printable 编码
-            filename_header = Header(filename, "utf-8", header_name="Content-Disposition")
-            filename_encoded = filename_header.encode(maxlinelen=76, linesep="\r\n")
+class FileIndex:
+    """文件索引（SQLite）：按 (路径, 大小, 修改时间) 缓存摘要和验证结果，并记录每个摘要已发送到哪些 Kindle 邮箱
 
-            # 构造 Content-Disposition 头
-            content_disposition = f"attachment; filename=\"{filename_encoded}\""
-            part.add_header(
-                "Content-Disposition",
-                content_disposition
+    重命名的文件（同一 inode，大小和修改时间不变）也能命中缓存，不需要重新读取。
+    多个发送线程共用一个连接，由锁保护。
+    """
+
+    # 验证逻辑变化时递增，旧的缓存结果会被丢弃
+    VERSION = 4
+
+    def __init__(self, path=INDEX_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            if self.db.execute("PRAGMA user_version").fetchone()[0] != self.VERSION:
+                self.db.execute("DROP TABLE IF EXISTS files")
+                self.db.execute(f"PRAGMA user_version = {self.VERSION}")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, dev INTEGER, ino INTEGER, "
+                "digest TEXT, format TEXT)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS files_identity ON files (size, mtime_ns, dev, ino)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS deliveries ("
+                "digest TEXT, kindle_email TEXT, filename TEXT, delivered_at REAL, "
+                "PRIMARY KEY (digest, kindle_email))"
             )
-            part.add_header(
-                "Content-Type",
-                "application/epub+zip"
+            # 永久拒收（如地址不存在）的收件人，之后的批次不再向其发送这本书
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS refusals ("
+                "digest TEXT, kindle_email TEXT, code INTEGER, refused_at REAL, "
+                "PRIMARY KEY (digest, kindle_email))"
             )
-            logging.debug(f"Content-Disposition header: {content_disposition}")
 
-            msg.attach(part)
+    def inspect(self, file_path):
+        """返回 (格式, 摘要)，无效文件的格式为 None；文件未改动时直接使用缓存"""
+        path = os.path.abspath(file_path)
+        st = os.stat(path)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT format, digest FROM files WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, st.st_size, st.st_mtime_ns),
+            ).fetchone()
+            if row is None and st.st_ino:
+                row = self.db.execute(
+                    "SELECT format, digest FROM files WHERE size = ? AND mtime_ns = ? AND dev = ? AND ino = ?",
+                    (st.st_size, st.st_mtime_ns, st.st_dev, st.st_ino),
+                ).fetchone()
+        if row is not None:
+            file_format, digest = row
+        else:
+            file_format, digest = inspect_ebook(path)
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, dev, ino, digest, format) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (path, st.st_size, st.st_mtime_ns, st.st_dev, st.st_ino, digest, file_format),
+            )
+        return file_format, digest
 
-            logging.debug(f"Email content:\n{msg.as_string()}")
+    def delivered_as(self, digest, kindle_email):
+        """该内容已发送到 kindle_email 时返回当时的文件名，否则返回 None"""
+        if digest is None:
+            return None
+        with self.lock:
+            row = self.db.execute(
+                "SELECT filename FROM deliveries WHERE digest = ? AND kindle_email = ?",
+                (digest, kindle_email.strip().lower()),
+            ).fetchone()
+        return row[0] if row else None
 
-            if email_provider == "Gmail":
-                smtp_server = "smtp.gmail.com"
-                smtp_port = 587
-                server = smtplib.SMTP(smtp_server, smtp_port, timeout=60)
-                server.starttls()
+    def mark_delivered(self, digest, kindle_email, filename):
+        if digest is None:
+            return
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO deliveries (digest, kindle_email, filename, delivered_at) VALUES (?, ?, ?, ?)",
+                (digest, kindle_email.strip().lower(), filename, time.time()),
+            )
+
+    def refused_as(self, digest, kindle_email):
+        """kindle_email 曾永久拒收该内容时返回当时的 SMTP 回复码，否则返回 None"""
+        if digest is None:
+            return None
+        with self.lock:
+            row = self.db.execute(
+                "SELECT code FROM refusals WHERE digest = ? AND kindle_email = ?",
+                (digest, kindle_email.strip().lower()),
+            ).fetchone()
+        return row[0] if row else None
+
+    def mark_refused(self, digest, kindle_email, code):
+        if digest is None:
+            return
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO refusals (digest, kindle_email, code, refused_at) VALUES (?, ?, ?, ?)",
+                (digest, kindle_email.strip().lower(), code, time.time()),
+            )
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class StreamingMessage:
+    """流式邮件：头部仍用 Header 构造，附件在发送时分块读取并 base64 编码后直接写入 DATA，内存占用与文件大小无关
+
+    attachments 为 [(文件路径, MIME 类型), ...]，可以在一封邮件中附带多本书；
+    上传的是另一个文件（如压缩后的缓存）时用 (文件路径, MIME 类型, 附件名) 指定邮件中显示的文件名。
+    to_addrs 可以是一个地址或地址列表，多个收件人在同一个 SMTP 事务中发送，邮件只编码和上传一次。
+    """
+
+    def __init__(self, from_addr, to_addrs, attachments):
+        self.from_addr = from_addr
+        self.to_addrs = [to_addrs] if isinstance(to_addrs, str) else list(to_addrs)
+        self.attachments = [(attachment[0], attachment[1]) for attachment in attachments]
+        self.filenames = [attachment[2] if len(attachment) > 2 else os.path.basename(attachment[0])
+                          for attachment in attachments]
+        self.filename = self.filenames[0]
+        self.book_name = os.path.splitext(self.filename)[0]
+        self.boundary = f"===============kindle{uuid.uuid4().hex}=="
+        self.headers = self._build_headers()
+        self.part_headers = [self._build_part_headers(n, filename, mime_type)
+                             for n, (filename, (_, mime_type)) in enumerate(zip(self.filenames, self.attachments))]
+        self.trailer = f"\r\n--{self.boundary}--\r\n".encode("ascii")
+        self.size = len(self.headers) + len(self.trailer) + sum(
+            len(part_header) + base64_encoded_size(os.path.getsize(file_path))
+            for part_header, (file_path, _) in zip(self.part_headers, self.attachments)
+        )
+
+    def _build_headers(self):
+        # 设置邮件主题为书名（去掉扩展名后的文件名），多本书时注明数量
+        subject_text = self.book_name
+        if len(self.attachments) > 1:
+            subject_text = f"{self.book_name} 等{len(self.attachments)}本"
+        subject_header = Header(subject_text, "utf-8")
+        subject = subject_header.encode(maxlinelen=76, linesep="\r\n")
+
+        lines = [
+            f"From: {self.from_addr}",
+            f"To: {', '.join(self.to_addrs)}",
+            f"Subject: {subject}",
+            f"Date: {formatdate(localtime=True)}",
+            f"Message-ID: {make_msgid()}",
+            "MIME-Version: 1.0",
+            f"Content-Type: multipart/mixed; boundary=\"{self.boundary}\"",
+            "",
+            "",
+        ]
+        return _quote_periods("\r\n".join(lines).encode("ascii"))
+
+    def _build_part_headers(self, n, filename, mime_type):
+        # 使用 Header 明确指定 quoted-printable 编码
+        filename_header = Header(filename, "utf-8", header_name="Content-Disposition")
+        filename_encoded = filename_header.encode(maxlinelen=76, linesep="\r\n")
+
+        # 构造 Content-Disposition 头
+        content_disposition = f"attachment; filename=\"{filename_encoded}\""
+        logging.debug(f"Content-Disposition header: {content_disposition}")
+
+        lines = [
+            # 第一个分隔行紧接在邮件头的空行之后，之后的分隔行前需要换行
+            f"--{self.boundary}" if n == 0 else f"\r\n--{self.boundary}",
+            f"Content-Type: {mime_type}",
+            "MIME-Version: 1.0",
+            "Content-Transfer-Encoding: base64",
+            f"Content-Disposition: {content_disposition}",
+            "",
+            "",
+        ]
+        return _quote_periods("\r\n".join(lines).encode("ascii"))
+
+    def iter_chunks(self):
+        """按块生成完整的邮件数据（CRLF 换行），每次调用都会重新读取文件"""
+        yield self.headers
+        for part_header, (file_path, _) in zip(self.part_headers, self.attachments):
+            yield part_header
+            with open(file_path, "rb") as attachment:
+                while chunk := attachment.read(STREAM_CHUNK_SIZE):
+                    yield base64.encodebytes(chunk).replace(b"\n", b"\r\n")
+        yield self.trailer
+
+def _quote_periods(data):
+    # SMTP 透明性：行首的 "." 需要转义（base64 正文不会出现 "."）
+    return re.sub(rb"(?m)^\.", b"..", data)
+
+def base64_encoded_size(nbytes):
+    """返回 nbytes 字节按每行 76 字符、CRLF 换行做 base64 编码后的字节数"""
+    full_lines, rest = divmod(nbytes, 57)
+    size = full_lines * 78
+    if rest:
+        size += (rest + 2) // 3 * 4 + 2
+    return size
+
+def pack_files(file_sizes, max_message_bytes, max_attachments):
+    """按首次适应递减（FFD）把文件装箱，每箱编码后的大小不超过 max_message_bytes、文件数不超过 max_attachments
+
+    file_sizes 为 {文件: 字节数}，返回 [[文件, ...], ...]。超过上限的单个文件单独成箱。
+    """
+    bins = []
+    for file in sorted(file_sizes, key=lambda f: (-file_sizes[f], f)):
+        size = base64_encoded_size(file_sizes[file]) + ATTACHMENT_OVERHEAD_BYTES
+        for packed in bins:
+            if packed["size"] + size <= max_message_bytes and len(packed["files"]) < max_attachments:
+                packed["files"].append(file)
+                packed["size"] += size
+                break
+        else:
+            bins.append({"files": [file], "size": size})
+    return [packed["files"] for packed in bins]
+
+def get_optimize_options(config=None):
+    """返回 EPUB 压缩选项：默认值加上 config.json 中 optimize_epub 的覆盖项"""
+    options = dict(EPUB_OPTIMIZE_DEFAULTS)
+    options.update((config or {}).get("optimize_epub", {}))
+    return options
+
+def optimize_epub(epub_path, cache_dir, options):
+    """压缩一本 EPUB 并写入缓存，返回 {"path": 缓存路径, "bytes": 原大小, "optimized_bytes": 压缩后大小, "cached": 是否命中缓存,
+    "seconds": 耗时}；压缩效果不明显时 path 为 None
+
+    在进程池中运行。重新以最高级别 deflate 打包（mimetype 仍为第一个、不压缩的条目），按选项缩小过大的图片、删除字体。
+    缓存按原文件的 SHA-256 和压缩选项命名，同一本书改名或重新放入也不会再次压缩。
+    """
+    started = time.perf_counter()
+    hasher = hashlib.sha256()
+    with open(epub_path, "rb") as f:
+        while chunk := f.read(65536):
+            hasher.update(chunk)
+        original_size = f.tell()
+    options_key = hashlib.sha256(json.dumps([OPTIMIZE_VERSION, options], sort_keys=True).encode()).hexdigest()[:12]
+    cache_path = os.path.join(cache_dir, f"{hasher.hexdigest()}-{options_key}.epub")
+    # 压缩无效的书记一个空的标记文件，下次直接跳过
+    skip_path = cache_path + ".skip"
+    result = {"path": None, "bytes": original_size, "optimized_bytes": original_size, "cached": True}
+    if os.path.exists(cache_path):
+        result.update(path=cache_path, optimized_bytes=os.path.getsize(cache_path))
+    if result["path"] is not None or os.path.exists(skip_path):
+        result["seconds"] = time.perf_counter() - started
+        return result
+
+    # 只有压缩 EPUB 时用到（在进程池中运行），按需导入以加快启动
+    import importlib.util
+    import zipfile
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with zipfile.ZipFile(epub_path) as source, \
+                zipfile.ZipFile(temp_path, "w", zipfile.ZIP_DEFLATED, compresslevel=9) as target:
+            infos = [info for info in source.infolist() if not info.is_dir()]
+            fonts = _removable_fonts(source, infos, options)
+            opf_name = _opf_name(source) if fonts else None
+            max_side = options.get("max_image_side") or 0
+            if max_side and importlib.util.find_spec("PIL") is None:
+                max_side = 0
+            # EPUB 规范要求 mimetype 是第一个条目且不压缩
+            target.writestr(zipfile.ZipInfo("mimetype"), EPUB_MIMETYPE, zipfile.ZIP_STORED)
+            # 逐个条目读出、处理、写入，内存中只有当前这一个条目
+            for info in infos:
+                if info.filename == "mimetype" or info.filename in fonts:
+                    continue
+                data = source.read(info)
+                name = info.filename.lower()
+                if info.filename == opf_name:
+                    data = _remove_manifest_items(data, opf_name, fonts)
+                elif max_side and name.endswith((".jpg", ".jpeg", ".png")):
+                    data = _downsample_image(data, max_side, options.get("jpeg_quality", 85))
+                if name.endswith(STORED_EXTENSIONS):
+                    target.writestr(zipfile.ZipInfo(info.filename, info.date_time), data, zipfile.ZIP_STORED)
+                else:
+                    # writestr 传入 ZipInfo 时不会沿用 ZipFile 的 compresslevel，需要逐条指定
+                    target.writestr(zipfile.ZipInfo(info.filename, info.date_time), data, zipfile.ZIP_DEFLATED, compresslevel=9)
+        optimized_size = os.path.getsize(temp_path)
+        result["cached"] = False
+        if optimized_size > original_size * (1 - OPTIMIZE_MIN_SAVING) or not is_valid_epub(temp_path):
+            open(skip_path, "wb").close()
+        else:
+            os.replace(temp_path, cache_path)
+            result.update(path=cache_path, optimized_bytes=optimized_size)
+        result["seconds"] = time.perf_counter() - started
+        return result
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def _removable_fonts(source, infos, options):
+    """返回可以删除的字体文件名集合：strip_fonts 时为全部字体，否则为样式表和页面中都没有引用的字体
+
+    无法确定是否被引用的字体一律保留：OPF 读不到，或清单中有同名但解析不到该路径的条目时都不删除。
+    """
+    names = {info.filename for info in infos}
+    fonts = {name for name in names if name.lower().endswith(FONT_EXTENSIONS)}
+    # 加密（混淆）的字体在 encryption.xml 中登记，删除后会留下无效的引用，这种书不处理字体
+    if not fonts or "META-INF/encryption.xml" in names:
+        return set()
+    if not options.get("strip_fonts"):
+        # 一次只读一个页面，去掉其中引用到的字体
+        for info in infos:
+            if fonts and info.filename.lower().endswith((".css", ".xhtml", ".html", ".htm", ".svg")):
+                page = source.read(info)
+                referenced = {posixpath.basename(reference) for reference in _page_references(page)}
+                fonts = {name for name in fonts if posixpath.basename(name) not in referenced
+                         and posixpath.basename(name).encode("utf-8") not in page}
+    if not fonts:
+        return fonts
+    opf_name = _opf_name(source)
+    try:
+        opf = source.read(opf_name) if opf_name else None
+    except KeyError:
+        opf = None
+    if opf is None:
+        return set()
+    listed = {_manifest_path(match, opf_name) for match in MANIFEST_ITEM.finditer(opf)}
+    listed_names = {posixpath.basename(path) for path in listed}
+    return {name for name in fonts if name in listed or posixpath.basename(name) not in listed_names}
+
+def _page_references(page):
+    """返回页面或样式表中引用的资源路径（已做百分号和 HTML 实体解码，去掉 # 和 ? 之后的部分）"""
+    import html
+    from urllib.parse import unquote
+    references = []
+    for match in RESOURCE_REFERENCE.finditer(page):
+        value = next(group for group in match.groups() if group is not None)
+        value = unquote(html.unescape(value.decode("utf-8", "replace")))
+        references.append(re.split(r"[#?]", value, maxsplit=1)[0])
+    return references
+
+def _opf_name(source):
+    """从 META-INF/container.xml 取 OPF 文件在压缩包中的路径，找不到时返回 None"""
+    try:
+        container = source.read("META-INF/container.xml")
+    except KeyError:
+        return None
+    match = re.search(rb'full-path\s*=\s*["\']([^"\']+)["\']', container)
+    return match.group(1).decode("utf-8") if match else None
+
+def _manifest_path(match, opf_name):
+    """把 MANIFEST_ITEM 匹配到的 href（相对于 OPF，可能经过百分号编码）解析为压缩包中的路径"""
+    from urllib.parse import unquote
+    href = unquote(match.group(1).decode("utf-8", "replace"))
+    return posixpath.normpath(posixpath.join(posixpath.dirname(opf_name), href))
+
+def _remove_manifest_items(opf, opf_name, removed):
+    """从 OPF 清单中删除指向 removed 中文件的 <item>"""
+    return MANIFEST_ITEM.sub(lambda match: b"" if _manifest_path(match, opf_name) in removed else match.group(0), opf)
+
+def _downsample_image(data, max_side, jpeg_quality):
+    """用 Pillow 把长边超过 max_side 的 JPEG/PNG 按比例缩小，结果没有变小时返回原数据"""
+    from PIL import Image
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if max(image.size) <= max_side or image.format not in ("JPEG", "PNG"):
+                return data
+            image_format = image.format
+            image.thumbnail((max_side, max_side), Image.LANCZOS)
+            output = io.BytesIO()
+            if image_format == "JPEG":
+                if image.mode not in ("RGB", "L"):
+                    image = image.convert("RGB")
+                image.save(output, "JPEG", quality=jpeg_quality, optimize=True)
+            else:
+                image.save(output, "PNG", optimize=True)
+    except Exception:
+        # 无法识别或损坏的图片保持原样
+        return data
+    resized = output.getvalue()
+    return resized if len(resized) < len(data) else data
+
+def get_convert_options(config=None):
+    """返回文档转换选项：默认值加上 config.json 中 convert_documents 的覆盖项"""
+    options = dict(CONVERT_DEFAULTS)
+    options.update((config or {}).get("convert_documents", {}))
+    return options
+
+def parse_document_name(file_path):
+    """从文件名取 (书名, 作者)：支持“书名 - 作者”“《书名》作者”和“书名（作者）”，没有作者时为空字符串"""
+    stem = os.path.splitext(os.path.basename(file_path))[0].strip()
+    match = (re.match(r"^《(.+?)》\s*(.*)$", stem)
+             or re.match(r"^(.+?)\s+-\s+(.+)$", stem)
+             or re.match(r"^(.+?)\s*[（(]([^（）()]+)[）)]$", stem))
+    if match is None:
+        return stem, ""
+    title, author = match.group(1).strip(), match.group(2).strip()
+    author = re.sub(r"^(作者|著)\s*[:：]?\s*|\s*(著|编著)$", "", author)
+    return title, author
+
+def _decode_text(data):
+    """按 BOM、UTF-8、GB18030 的顺序解码文本文件（中文 TXT 常见 GBK 编码）"""
+    if data.startswith((b"\xff\xfe", b"\xfe\xff")):
+        return data.decode("utf-16")
+    for encoding in ("utf-8-sig", "gb18030"):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return data.decode("latin-1")
+
+def _text_blocks(text):
+    """纯文本：每个非空行一段，符合 CHAPTER_PATTERN 的短行作为一级标题，返回 [(标题级别, 标题, XHTML), ...]"""
+    # 文档转换的各个函数都在进程池中运行，按需导入以加快启动
+    import html
+    blocks = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if len(line) <= 40 and CHAPTER_PATTERN.match(line):
+            blocks.append((1, line, f"<h1>{html.escape(line, quote=False)}</h1>"))
+        else:
+            blocks.append((0, "", f"<p>{html.escape(line, quote=False)}</p>"))
+    return blocks
+
+def _markdown_inline(text):
+    """Markdown 行内语法：行内代码、图片（只保留说明文字）、链接、粗体和斜体"""
+    import html
+    parts = re.split(r"(`[^`]+`)", text)
+    for n, part in enumerate(parts):
+        if n % 2:
+            parts[n] = f"<code>{html.escape(part[1:-1], quote=False)}</code>"
+            continue
+        part = html.escape(part, quote=False)
+        part = re.sub(r"!\[([^\]]*)\]\([^)]*\)", r"\1", part)
+        part = re.sub(r"\[([^\]]+)\]\((https?://[^)\s\"]+)[^)]*\)", r'<a href="\2">\1</a>', part)
+        part = re.sub(r"\[([^\]]+)\]\([^)]*\)", r"\1", part)
+        part = re.sub(r"(\*\*|__)(?=\S)(.+?)(?<=\S)\1", r"<strong>\2</strong>", part)
+        part = re.sub(r"(?<![\w*])([*_])(?=\S)(.+?)(?<=\S)\1(?![\w*])", r"<em>\2</em>", part)
+        parts[n] = part
+    return "".join(parts)
+
+def _markdown_blocks(text):
+    """Markdown 的常用块语法：标题、段落、列表、引用、代码块和分隔线，返回 [(标题级别, 标题, XHTML), ...]"""
+    import html
+    blocks = []
+    paragraph = []
+    list_items = []
+    list_tag = None
+    code = None
+
+    def flush():
+        nonlocal list_tag
+        if paragraph:
+            blocks.append((0, "", f"<p>{_markdown_inline(' '.join(paragraph))}</p>"))
+            paragraph.clear()
+        if list_items:
+            items = "".join(f"<li>{_markdown_inline(item)}</li>" for item in list_items)
+            blocks.append((0, "", f"<{list_tag}>{items}</{list_tag}>"))
+            list_items.clear()
+            list_tag = None
+
+    for line in text.splitlines():
+        stripped = line.strip()
+        if code is not None:
+            if stripped.startswith("```"):
+                blocks.append((0, "", f"<pre><code>{html.escape(chr(10).join(code), quote=False)}</code></pre>"))
+                code = None
             else:
-                smtp_server = "smtp.qq.com"
-                smtp_port = 465
-                server = smtplib.SMTP_SSL(smtp_server, smtp_port, timeout=60)
-
-            server.login(email_username, email_password)
-            server.sendmail(email_username, kindle_email, msg.as_string())
-            server.quit()
-            logging.info(f"Sent: {epub_path} -> {kindle_email}")
+                code.append(line)
+            continue
+        if stripped.startswith("```"):
+            flush()
+            code = []
+            continue
+        if not stripped:
+            flush()
+            continue
+        heading = re.match(r"^(#{1,6})\s+(.*?)(\s+#+)?$", stripped)
+        item = re.match(r"^([-*+]|\d+[.)])\s+(.*)$", stripped)
+        if heading:
+            flush()
+            level = len(heading.group(1))
+            title = re.sub(r"[*_`]", "", heading.group(2))
+            blocks.append((level, title, f"<h{level}>{_markdown_inline(heading.group(2))}</h{level}>"))
+        elif re.match(r"^([-*_])(\s*\1){2,}$", stripped):
+            flush()
+            blocks.append((0, "", "<hr/>"))
+        elif item:
+            tag = "ul" if item.group(1) in "-*+" else "ol"
+            if paragraph or (list_tag and list_tag != tag):
+                flush()
+            list_tag = tag
+            list_items.append(item.group(2))
+        elif stripped.startswith(">"):
+            flush()
+            blocks.append((0, "", f"<blockquote><p>{_markdown_inline(stripped.lstrip('> '))}</p></blockquote>"))
+        elif list_items:
+            # 列表项的续行
+            list_items[-1] += " " + stripped
+        else:
+            paragraph.append(stripped)
+    if code is not None:
+        blocks.append((0, "", f"<pre><code>{html.escape(chr(10).join(code), quote=False)}</code></pre>"))
+    flush()
+    return blocks
+
+def _html_blocks(text):
+    """HTML：按 HTMLBlocks 的规则解析，返回 [(标题级别, 标题, XHTML), ...]"""
+    import html
+    from html.parser import HTMLParser
+
+    class HTMLBlocks(HTMLParser):
+        """把任意（可能不规范的）HTML 整理成格式正确的 XHTML 块
+
+        只保留常见的正文标签，去掉脚本、样式、图片等外部资源；div、section 等容器标签不保留，
+        其中的标题因此成为顶层块，可用于拆分章节。未闭合的标签自动闭合，顶层的零散文字放入段落。
+        """
+
+        BLOCK_TAGS = {"p", "h1", "h2", "h3", "h4", "h5", "h6", "ul", "ol", "li", "dl", "dt", "dd", "blockquote", "pre",
+                      "table", "thead", "tbody", "tr", "td", "th", "figcaption"}
+        INLINE_TAGS = {"a", "em", "strong", "b", "i", "u", "s", "code", "sup", "sub", "small", "q", "cite", "abbr", "mark"}
+        SKIP_TAGS = {"script", "style", "head", "title", "noscript", "iframe", "object", "svg", "math", "template"}
+        # 再次出现时自动闭合前一个（HTML 允许省略这些结束标签）
+        AUTO_CLOSE_TAGS = {"p", "li", "dt", "dd", "tr", "td", "th"}
+
+        def __init__(self):
+            super().__init__(convert_charrefs=True)
+            self.blocks = []
+            self.stack = []
+            self.parts = []
+            self.heading = None
+            self.implicit = False
+            self.skip = 0
+
+        def handle_starttag(self, tag, attrs):
+            if tag in self.SKIP_TAGS:
+                self.skip += 1
+                return
+            if self.skip:
+                return
+            if tag in ("br", "hr"):
+                if tag == "hr" and (not self.stack or self.implicit):
+                    self._flush()
+                    self.blocks.append((0, "", "<hr/>"))
+                else:
+                    self._ensure_block()
+                    self.parts.append(f"<{tag}/>")
+                return
+            if tag == "img":
+                alt = dict(attrs).get("alt")
+                if alt:
+                    self.handle_data(alt)
+                return
+            if tag not in self.BLOCK_TAGS and tag not in self.INLINE_TAGS:
+                return
+            if tag in self.AUTO_CLOSE_TAGS and tag in self.stack:
+                self.handle_endtag(tag)
+            if tag in self.BLOCK_TAGS and "p" in self.stack:
+                # 段落中不能包含块级标签，HTML 中块级标签的开始隐含着段落的结束
+                self.handle_endtag("p")
+            if tag in self.BLOCK_TAGS and self.implicit:
+                self._flush()
+            if tag in self.INLINE_TAGS:
+                self._ensure_block()
+            if not self.stack and re.fullmatch(r"h[1-6]", tag):
+                self.heading = (int(tag[1]), [])
+            attributes = ""
+            href = dict(attrs).get("href") or ""
+            if tag == "a" and re.match(r"^(https?:|mailto:)", href):
+                attributes = f' href="{html.escape(href)}"'
+            self.parts.append(f"<{tag}{attributes}>")
+            self.stack.append(tag)
+
+        def handle_endtag(self, tag):
+            if tag in self.SKIP_TAGS:
+                self.skip = max(0, self.skip - 1)
+                return
+            if self.skip or tag not in self.stack:
+                return
+            while self.stack:
+                open_tag = self.stack.pop()
+                self.parts.append(f"</{open_tag}>")
+                if open_tag == tag:
+                    break
+            if not self.stack:
+                self._flush()
+
+        def handle_data(self, data):
+            if self.skip or (not self.stack and not data.strip()):
+                return
+            self._ensure_block()
+            self.parts.append(html.escape(data, quote=False))
+            if self.heading is not None:
+                self.heading[1].append(data)
+
+        def _ensure_block(self):
+            if not self.stack:
+                self.parts.append("<p>")
+                self.stack.append("p")
+                self.implicit = True
+
+        def _flush(self):
+            while self.stack:
+                self.parts.append(f"</{self.stack.pop()}>")
+            content = "".join(self.parts)
+            if re.search(r">[^<]*\S", content):
+                if self.heading is not None:
+                    level, text = self.heading
+                    self.blocks.append((level, " ".join("".join(text).split()), content))
+                else:
+                    self.blocks.append((0, "", content))
+            self.parts = []
+            self.heading = None
+            self.implicit = False
+
+        def close(self):
+            super().close()
+            self._flush()
+
+    parser = HTMLBlocks()
+    parser.feed(text)
+    parser.close()
+    return parser.blocks
+
+def split_chapters(blocks, title, language, chapter_chars):
+    """按标题把块分成章节，返回 [(目录标题, [章节文件正文, ...]), ...]
+
+    按出现不止一次的最高级标题拆分（只出现一次的一级标题通常是书名）；没有标题时按 chapter_chars 分成若干部分。
+    过长的章节拆成多个文件，目录只指向第一个。
+    """
+    levels = [level for level, _, _ in blocks if level]
+    split_level = None
+    for level in sorted(set(levels)):
+        split_level = level
+        if levels.count(level) > 1:
+            break
+    chapters = []
+    for level, heading, content in blocks:
+        if not chapters or (split_level and level and level <= split_level):
+            chapters.append([heading if level else "", []])
+        chapters[-1][1].append(content)
+    if not chapters:
+        chapters = [["", ["<p></p>"]]]
+    if split_level is None:
+        # 没有标题：每 chapter_chars 字一部分，分别列入目录
+        parts = []
+        for content in chapters[0][1]:
+            if not parts or sum(map(len, parts[-1])) + len(content) > chapter_chars:
+                parts.append([])
+            parts[-1].append(content)
+        label = "第{}部分" if language == "zh" else "Part {}"
+        return [(title if len(parts) == 1 else label.format(n), ["\n".join(part)]) for n, part in enumerate(parts, 1)]
+    result = []
+    for heading, contents in chapters:
+        files = [[]]
+        for content in contents:
+            if files[-1] and sum(map(len, files[-1])) + len(content) > chapter_chars:
+                files.append([])
+            files[-1].append(content)
+        result.append((heading or title, ["\n".join(file) for file in files]))
+    return result
+
+def write_epub(epub_path, title, author, language, identifier, chapters):
+    """把章节写成 EPUB 3（同时带 EPUB 2 的 toc.ncx，兼容较旧的阅读器），chapters 来自 split_chapters"""
+    import html
+    import zipfile
+    esc = html.escape
+    xhtml_head = ('<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+                  f'<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" '
+                  f'lang="{language}" xml:lang="{language}">\n')
+    files = []
+    toc = []
+    for heading, contents in chapters:
+        for n, content in enumerate(contents):
+            name = f"text/part{len(files) + 1:04d}.xhtml"
+            if n == 0:
+                toc.append((heading, name))
+            files.append((name, f"{xhtml_head}<head>\n<title>{esc(heading)}</title>\n"
+                                f'<link rel="stylesheet" type="text/css" href="../style.css"/>\n</head>\n'
+                                f"<body>\n{content}\n</body>\n</html>\n"))
+    nav_items = "\n".join(f'<li><a href="{esc(name)}">{esc(heading)}</a></li>' for heading, name in toc)
+    nav = (f"{xhtml_head}<head>\n<title>{esc(title)}</title>\n</head>\n<body>\n"
+           f'<nav epub:type="toc" id="toc">\n<h1>{esc(title)}</h1>\n<ol>\n{nav_items}\n</ol>\n</nav>\n</body>\n</html>\n')
+    nav_points = "\n".join(
+        f'<navPoint id="nav{n}" playOrder="{n}"><navLabel><text>{esc(heading)}</text></navLabel>'
+        f'<content src="{esc(name)}"/></navPoint>'
+        for n, (heading, name) in enumerate(toc, 1))
+    ncx = ('<?xml version="1.0" encoding="utf-8"?>\n<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">\n'
+           f'<head><meta name="dtb:uid" content="{esc(identifier)}"/></head>\n'
+           f"<docTitle><text>{esc(title)}</text></docTitle>\n<navMap>\n{nav_points}\n</navMap>\n</ncx>\n")
+    manifest = "\n".join(f'<item id="p{n}" href="{name}" media-type="application/xhtml+xml"/>'
+                         for n, (name, _) in enumerate(files, 1))
+    spine = "\n".join(f'<itemref idref="p{n}"/>' for n in range(1, len(files) + 1))
+    creator = f"<dc:creator>{esc(author)}</dc:creator>\n" if author else ""
+    modified = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    opf = ('<?xml version="1.0" encoding="utf-8"?>\n'
+           '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id">\n'
+           '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
+           f'<dc:identifier id="book-id">{esc(identifier)}</dc:identifier>\n<dc:title>{esc(title)}</dc:title>\n'
+           f'{creator}<dc:language>{language}</dc:language>\n<meta property="dcterms:modified">{modified}</meta>\n'
+           '</metadata>\n<manifest>\n'
+           '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>\n'
+           '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>\n'
+           '<item id="css" href="style.css" media-type="text/css"/>\n'
+           f'{manifest}\n</manifest>\n<spine toc="ncx">\n{spine}\n</spine>\n</package>\n')
+    container = ('<?xml version="1.0" encoding="utf-8"?>\n'
+                 '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">\n'
+                 '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>\n'
+                 '</container>\n')
+    style = "p { text-indent: 2em; margin: 0.3em 0; }\nh1, h2, h3 { text-align: center; }\npre { white-space: pre-wrap; }\n"
+    with zipfile.ZipFile(epub_path, "w", zipfile.ZIP_DEFLATED, compresslevel=9) as epub:
+        epub.writestr(zipfile.ZipInfo("mimetype"), EPUB_MIMETYPE, zipfile.ZIP_STORED)
+        epub.writestr("META-INF/container.xml", container)
+        epub.writestr("OEBPS/content.opf", opf)
+        epub.writestr("OEBPS/nav.xhtml", nav)
+        epub.writestr("OEBPS/toc.ncx", ncx)
+        epub.writestr("OEBPS/style.css", style)
+        for name, content in files:
+            epub.writestr(f"OEBPS/{name}", content)
+
+def convert_document(file_path, cache_dir, options):
+    """把 TXT、Markdown 或 HTML 文档转换为 EPUB 并写入缓存，返回 {"path": EPUB 路径, "bytes": 原大小,
+    "converted_bytes": EPUB 大小, "chapters": 章节数, "cached": 是否命中缓存, "seconds": 耗时}
+
+    在进程池中运行，只使用标准库。书名和作者取自文件名（见 parse_document_name），章节按标题拆分（见 split_chapters）。
+    缓存按原文件的 SHA-256、文件名和转换选项命名，内容和文件名都没变的文档不会再次转换。
+    """
+    started = time.perf_counter()
+    with open(file_path, "rb") as f:
+        data = f.read()
+    key = hashlib.sha256(data)
+    key.update(json.dumps([CONVERT_VERSION, os.path.basename(file_path), options], sort_keys=True).encode())
+    epub_path = os.path.join(cache_dir, f"{key.hexdigest()}.epub")
+    result = {"path": epub_path, "bytes": len(data), "cached": True}
+    if not os.path.exists(epub_path):
+        text = _decode_text(data)
+        ext = os.path.splitext(file_path)[1].lower().lstrip(".")
+        if ext in ("md", "markdown"):
+            blocks = _markdown_blocks(text)
+        elif ext in ("html", "htm"):
+            blocks = _html_blocks(text)
+        else:
+            blocks = _text_blocks(text)
+        title, author = parse_document_name(file_path)
+        language = "zh" if re.search(r"[一-鿿]", text[:10000] + title) else "en"
+        chapters = split_chapters(blocks, title, language, options.get("chapter_chars", CONVERT_DEFAULTS["chapter_chars"]))
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_path = f"{epub_path}.{os.getpid()}.tmp"
+        try:
+            write_epub(temp_path, title, author, language, f"urn:sha256:{key.hexdigest()}", chapters)
+            if not is_valid_epub(temp_path):
+                raise InvalidFileError(f"Converted EPUB is not valid: {file_path}")
+            os.replace(temp_path, epub_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        result.update(cached=False, chapters=len(chapters))
+    result["converted_bytes"] = os.path.getsize(epub_path)
+    result["seconds"] = time.perf_counter() - started
+    return result
+
+def send_to_kindle(epub_path, email_provider, email_username, email_password, kindle_email, retries=3, delay=5, session=None,
+                   index=None):
+    """发送电子书到 Kindle，支持重试机制
+
+    传入 session 时复用其 SMTP 连接，否则为本次发送单独建立连接；传入 index 时复用缓存的验证结果。
+    """
+    return send_books_to_kindle([epub_path], email_provider, email_username, email_password, kindle_email,
+                                retries, delay, session, index)
+
+def send_books_to_kindle(file_paths, email_provider, email_username, email_password, kindle_email, retries=3, delay=5,
+                         session=None, index=None):
+    """把多本书作为一封邮件的多个附件发送到 Kindle，全部送达返回 True（SMTP 事务要么整体成功，要么整体失败）"""
+    own_session = session is None
+    if own_session:
+        session = SMTPSession(email_provider, email_username, email_password)
+    try:
+        return _send_with_retries(file_paths, email_username, kindle_email, session, retries, delay, index)
+    finally:
+        if own_session:
+            session.close()
+
+def _send_with_retries(file_paths, email_username, kindle_email, session, retries, delay, index):
+    description = describe_files(file_paths)
+    policy = RetryPolicy(max_attempts=retries, base_delay=delay)
+    for attempt in range(retries):
+        try:
+            deliver_books(file_paths, email_username, kindle_email, session, index)
             return True
         except Exception as e:
-            logging.error(f"Failed to send {epub_path} (attempt {attempt + 1}/{retries}): {e}")
-            if attempt == retries - 1:
+            error_class = classify_smtp_error(e)
+            logging.error(f"Failed to send {description} (attempt {attempt + 1}/{retries}, {error_class}): {e}")
+            session.reset()
+            if error_class == PERMANENT or attempt == retries - 1:
                 return False
-            time.sleep(delay)
+            time.sleep(policy.delay(attempt, error_class))
     return False
 
-def move_file(epub_path, success, sent_dir, failed_dir):
-    """移动文件到成功或失败目录"""
+def describe_files(file_paths):
+    return file_paths[0] if len(file_paths) == 1 else f"{len(file_paths)} files ({', '.join(file_paths)})"
+
+class InvalidFileError(Exception):
+    """文件无效或格式不受支持，重试也不会成功"""
+
+def parse_recipients(text):
+    """把用逗号、分号或空白分隔的多个 Kindle 邮箱拆成列表，去掉重复的地址（不区分大小写）"""
+    recipients = []
+    for address in re.split(r"[,;\s]+", text or ""):
+        if address and address.lower() not in (r.lower() for r in recipients):
+            recipients.append(address)
+    return recipients
+
+def deliver_books(file_paths, email_username, kindle_email, session, index=None, on_progress=None, upload_paths=None):
+    """单次发送尝试（不重试），失败时抛出异常，由调用方决定是否重试
+
+    kindle_email 可以是地址列表或用逗号分隔的字符串。部分收件人被拒收时不抛出异常，返回 {地址: (代码, 回复)}。
+    on_progress 传给 SMTPSession.send_message，上传过程中报告已写入的字节数。
+    upload_paths 为 {文件路径: 实际上传的文件}（转换或压缩后的 EPUB），附件名使用原文件名（扩展名改为实际上传文件的扩展名）。
+    """
+    recipients = parse_recipients(kindle_email) if isinstance(kindle_email, str) else list(kindle_email)
+    attachments = []
+    for file_path in file_paths:
+        upload_path = (upload_paths or {}).get(file_path, file_path)
+        file_name = os.path.basename(file_path)
+        if upload_path != file_path:
+            # 上传的是转换或压缩后的文件，原文件在发送前已验证过，这里只检查实际上传的文件
+            file_format = check_ebook(upload_path)
+            file_name = os.path.splitext(file_name)[0] + os.path.splitext(upload_path)[1]
+        else:
+            file_format = index.inspect(file_path)[0] if index is not None else check_ebook(file_path)
+        if file_format not in KINDLE_FORMATS:
+            raise InvalidFileError(f"Invalid or unsupported file: {file_path}")
+        attachments.append((upload_path, KINDLE_FORMATS[file_format], file_name))
+
+    message = StreamingMessage(email_username, recipients, attachments)
+    logging.info(f"Extracted book name: {message.book_name} from file: {message.filename}")
+    logging.debug(f"Email headers:\n{message.headers.decode('ascii', errors='replace')}")
+
+    refused = session.send_message(message, on_progress)
+    accepted = [r for r in recipients if r not in refused]
+    logging.info(f"Sent: {describe_files(file_paths)} -> {', '.join(accepted)}")
+    for address, (code, resp) in refused.items():
+        logging.error(f"Recipient {address} refused {describe_files(file_paths)}: {code} {resp}")
+    return refused
+
+def classify_smtp_error(error):
+    """把发送异常分为 TRANSIENT（网络等临时故障）、THROTTLED（服务器限流或额度用完）和 PERMANENT（重试无用）"""
+    if isinstance(error, (smtplib.SMTPAuthenticationError, InvalidFileError)):
+        return PERMANENT
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        classes = [_classify_reply(code, resp) for code, resp in error.recipients.values()]
+        for error_class in (PERMANENT, THROTTLED):
+            if error_class in classes:
+                return error_class
+        return TRANSIENT
+    if isinstance(error, smtplib.SMTPResponseException):
+        return _classify_reply(error.smtp_code, error.smtp_error)
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, OSError)):
+        return TRANSIENT
+    return PERMANENT
+
+def _classify_reply(code, resp):
+    text = resp.decode("utf-8", errors="replace") if isinstance(resp, bytes) else str(resp)
+    if code == 421 or (400 <= code < 500 and THROTTLE_PATTERN.search(text)):
+        return THROTTLED
+    if 400 <= code < 500 or code < 0:
+        return TRANSIENT
+    # 部分服务器用 5xx 表示每日额度用完，等额度恢复后仍可发送
+    if QUOTA_PATTERN.search(text):
+        return THROTTLED
+    return PERMANENT
+
+class RetryPolicy:
+    """指数退避加随机抖动：第 n 次重试前等待 base * 2^n 秒（限流时基数更大），不超过 max_delay"""
+
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY,
+                 throttled_delay=RETRY_THROTTLED_DELAY, max_delay=RETRY_MAX_DELAY):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.throttled_delay = throttled_delay
+        self.max_delay = max_delay
+
+    def should_retry(self, attempt, error_class):
+        """attempt 为已失败的次数减一（从 0 开始）"""
+        return error_class != PERMANENT and attempt + 1 < self.max_attempts
+
+    def delay(self, attempt, error_class):
+        base = self.throttled_delay if error_class == THROTTLED else self.base_delay
+        delay = min(self.max_delay, base * (2 ** attempt))
+        # 在 [delay/2, delay] 之间随机，避免多个连接同时重试
+        return random.uniform(delay / 2, delay)
+
+class CircuitBreaker:
+    """提供商级别的熔断器：连续 failure_threshold 次临时故障或限流后暂停发送 cooldown 秒，
+    冷却期后放行试探，成功则恢复，失败则冷却时间加倍（不超过 max_cooldown）"""
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, cooldown=BREAKER_COOLDOWN,
+                 max_cooldown=BREAKER_MAX_COOLDOWN):
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0
+        self.open_until = 0
+        self.lock = threading.Lock()
+
+    def delay(self):
+        """熔断中返回还需等待的秒数，否则返回 0"""
+        with self.lock:
+            return max(0, self.open_until - time.monotonic())
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.cooldown = self.base_cooldown
+
+    def record_failure(self, error_class):
+        """记录一次失败，熔断器因此打开时返回 True（单个文件的永久错误不计入）"""
+        if error_class == PERMANENT:
+            return False
+        with self.lock:
+            self.failures += 1
+            if self.failures < self.failure_threshold:
+                return False
+            self.open_until = time.monotonic() + self.cooldown
+            logging.warning(f"Circuit breaker opened for {self.cooldown}s after {self.failures} consecutive failures.")
+            self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+            # 冷却结束后放行一次试探，再失败立即重新熔断
+            self.failures = self.failure_threshold - 1
+            return True
+
+class TokenBucket:
+    """令牌桶：容量为 capacity，每秒补充 rate 个令牌（非线程安全，由 RateLimiter 加锁）"""
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount):
+        """返回取得 amount 个令牌还需等待的秒数，超过容量的请求按容量计算"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount):
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+class DailyQuota:
+    """按 24 小时滚动窗口统计的发送额度，发送记录保存在 QUOTA_FILE 中，重启程序后仍然有效"""
+
+    WINDOW = 24 * 3600
+    # 多个账号的额度记录在同一个文件中，读改写需要互斥
+    file_lock = threading.Lock()
+
+    def __init__(self, key, limit, path=QUOTA_FILE):
+        self.key = key
+        self.limit = limit
+        self.path = path
+        self.timestamps = self._load()
+
+    def _load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, "r") as f:
+                    return sorted(json.load(f).get(self.key, []))
+        except Exception as e:
+            logging.error(f"Failed to load quota file: {e}")
+        return []
+
+    def _save(self):
+        try:
+            with self.file_lock:
+                data = {}
+                if os.path.exists(self.path):
+                    with open(self.path, "r") as f:
+                        data = json.load(f)
+                data[self.key] = self.timestamps
+                with open(self.path, "w") as f:
+                    json.dump(data, f)
+        except Exception as e:
+            logging.error(f"Failed to save quota file: {e}")
+
+    def _prune(self):
+        cutoff = time.time() - self.WINDOW
+        while self.timestamps and self.timestamps[0] <= cutoff:
+            self.timestamps.pop(0)
+
+    def remaining(self):
+        self._prune()
+        return max(0, self.limit - len(self.timestamps))
+
+    def delay(self, count=1):
+        """剩余额度够发送 count 封时返回 0，否则返回足够多的记录移出窗口还需等待的秒数"""
+        count = min(count, self.limit)
+        if self.remaining() >= count:
+            return 0
+        return self.timestamps[len(self.timestamps) - self.limit + count - 1] + self.WINDOW - time.time()
+
+    def consume(self, count=1):
+        self.timestamps.extend([time.time()] * count)
+        self._save()
+
+def get_rate_limits(email_provider, config=None):
+    """返回提供商的限速配置，config.json 中的 rate_limits 可以覆盖默认值"""
+    limits = dict(PROVIDER_LIMITS.get(email_provider, PROVIDER_LIMITS["QQ"]))
+    overrides = ((config or {}).get("rate_limits") or {}).get(email_provider) or {}
+    limits.update(overrides)
+    return limits
+
+class RateLimiter:
+    """多个发送线程共用的限速器：每分钟邮件数、每分钟字节数和每日额度三个条件都满足才放行"""
+
+    def __init__(self, email_provider, email_username, limits, quota_path=QUOTA_FILE):
+        self.messages = TokenBucket(limits["messages_per_minute"], limits["messages_per_minute"] / 60)
+        self.bytes = TokenBucket(limits["bytes_per_minute"], limits["bytes_per_minute"] / 60)
+        self.quota = DailyQuota(f"{email_provider}:{email_username}", limits["daily_quota"], quota_path)
+        self.lock = threading.Lock()
+
+    def delay(self, nbytes=0, recipients=1):
+        """返回发送一封 nbytes 字节的邮件还需等待的秒数（不消耗额度）"""
+        with self.lock:
+            return max(self.quota.delay(recipients), self.messages.delay(recipients), self.bytes.delay(nbytes))
+
+    def try_acquire(self, nbytes, recipients=1):
+        """不等待：允许发送时消耗额度并返回 (0, False)，否则返回 (需等待的秒数, 是否因每日额度用完)
+
+        提供商按收件人计数，一封邮件发给 recipients 个收件人消耗同样多的邮件数和每日额度。
+        """
+        with self.lock:
+            quota_delay = self.quota.delay(recipients)
+            delay = max(quota_delay, self.messages.delay(recipients), self.bytes.delay(nbytes))
+            if delay <= 0:
+                self.messages.consume(recipients)
+                self.bytes.consume(nbytes)
+                self.quota.consume(recipients)
+                return 0, False
+            return delay, quota_delay > 0
+
+    def acquire(self, nbytes, wait=time.sleep, on_wait=None, recipients=1):
+        """阻塞直到允许发送一封 nbytes 字节的邮件；wait 返回 False（已取消）时返回 False"""
+        while True:
+            delay, quota_exhausted = self.try_acquire(nbytes, recipients)
+            if delay <= 0:
+                return True
+            logging.info(f"Rate limited, waiting {delay:.1f}s (daily quota exhausted: {quota_exhausted}).")
+            if on_wait:
+                on_wait(delay, quota_exhausted)
+            # 分段等待，期间其他线程消耗或释放额度后重新计算
+            if wait(min(delay, 60)) is False:
+                return False
+
+class SenderAccount:
+    """账号池中的一个发件账号：SMTP 服务器和登录信息，以及该账号自己的限速器（含每日额度）和熔断器"""
+
+    def __init__(self, email_provider, email_username, email_password, limits=None, smtp_server=None,
+                 quota_path=QUOTA_FILE):
+        self.email_provider = email_provider
+        self.email_username = email_username
+        self.email_password = email_password
+        self.smtp_server = smtp_server or get_smtp_server(email_provider)
+        self.limits = limits or get_rate_limits(email_provider)
+        self.limiter = RateLimiter(email_provider, email_username, self.limits, quota_path)
+        self.breaker = CircuitBreaker()
+        # 被服务器限流时暂停到这个时间（time.monotonic()），期间由其他账号发送
+        self.throttled_until = 0
+        # 认证失败后停用，本批次不再使用
+        self.disabled = False
+
+    def __repr__(self):
+        return f"{self.email_username} ({self.smtp_server[0]})"
+
+    def new_session(self, max_messages=DEFAULT_MAX_MESSAGES_PER_CONNECTION):
+        return SMTPSession(self.email_provider, self.email_username, self.email_password, max_messages=max_messages,
+                           smtp_server=self.smtp_server)
+
+    def unavailable_for(self):
+        """返回该账号还需暂停的秒数（熔断或限流），可以立即发送时返回 0"""
+        return max(0, self.breaker.delay(), self.throttled_until - time.monotonic())
+
+def load_accounts(config, email_provider, email_username, email_password, quota_path=QUOTA_FILE):
+    """返回发件账号池：界面或命令行中填写的账号在前，之后是 config.json 中 accounts 列出的其他账号
+
+    accounts 中每一项包含 provider、username、password，自定义服务器另加 host、port、tls（starttls、ssl 或 none），
+    可用 rate_limits 覆盖该账号的限速配置。未知的提供商使用 QQ 邮箱的默认限速。
+    """
+    config = config or {}
+    accounts = [SenderAccount(email_provider, email_username, email_password,
+                              get_rate_limits(email_provider, config), quota_path=quota_path)]
+    for entry in config.get("accounts") or []:
+        provider = entry.get("provider") or entry.get("host")
+        username = entry.get("username", "")
+        if not provider or not username or not entry.get("password"):
+            logging.error(f"Ignoring incomplete account entry in config: {username or provider}")
+            continue
+        if provider == email_provider and username == email_username:
+            continue
+        if entry.get("host"):
+            default_port = 465 if entry.get("tls") == "ssl" else 587
+            smtp_server = (entry["host"], int(entry.get("port", default_port)), entry.get("tls", "starttls"))
+        elif provider in SMTP_SERVERS:
+            smtp_server = SMTP_SERVERS[provider]
+        else:
+            logging.error(f"Ignoring account {username}: unknown provider {provider} and no host given.")
+            continue
+        limits = get_rate_limits(provider, config)
+        limits.update(entry.get("rate_limits") or {})
+        accounts.append(SenderAccount(provider, username, entry["password"], limits, smtp_server, quota_path))
+    return accounts
+
+class ArchiveIndex:
+    """归档目录（已发送、发送失败）的内存索引：每个批次扫描一次目录，之后为重名文件分配后缀、查找内容相同的文件都不需要再遍历目录
+
+    已有文件按 文件名_序号.扩展名 记录每个文件名用到的最大序号，下一个空闲的名字直接算出。
+    内容相同的文件先按大小筛选，再比较摘要（传入 file_index 时使用其缓存），只有大小相同的文件才需要读取。
+    多个发送线程共用，由锁保护。
+    """
+
+    SUFFIX_PATTERN = re.compile(r"^(.*)_(\d+)$")
+
+    def __init__(self, directory, file_index=None):
+        self.directory = directory
+        self.file_index = file_index
+        self.lock = threading.Lock()
+        self.names = set()
+        self.next_suffix = {}
+        self.by_size = collections.defaultdict(list)
+        self.digests = {}
+        started = time.perf_counter()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    self._add(entry.name, entry.stat().st_size)
+        log_event("archive_index", directory=os.path.basename(directory), files=len(self.names),
+                  seconds=time.perf_counter() - started)
+
+    def _add(self, name, size):
+        self.names.add(os.path.normcase(name))
+        self.by_size[size].append(name)
+        stem, ext = os.path.splitext(name)
+        match = self.SUFFIX_PATTERN.match(stem)
+        if match:
+            key = os.path.normcase(match.group(1) + ext)
+            self.next_suffix[key] = max(self.next_suffix.get(key, 1), int(match.group(2)) + 1)
+
+    def _free_name(self, base_name):
+        """返回 base_name 或第一个没有用过的 名字_序号（调用方持有锁）"""
+        if os.path.normcase(base_name) not in self.names:
+            return base_name
+        name, ext = os.path.splitext(base_name)
+        key = os.path.normcase(base_name)
+        counter = self.next_suffix.get(key, 1)
+        while os.path.normcase(f"{name}_{counter}{ext}") in self.names:
+            counter += 1
+        self.next_suffix[key] = counter + 1
+        return f"{name}_{counter}{ext}"
+
+    def _digest(self, name):
+        if name not in self.digests:
+            path = os.path.join(self.directory, name)
+            try:
+                if self.file_index is not None:
+                    self.digests[name] = self.file_index.inspect(path)[1]
+                else:
+                    self.digests[name] = inspect_ebook(path)[1]
+            except OSError:
+                self.digests[name] = None
+        return self.digests[name]
+
+    def find_duplicate(self, size, digest):
+        """返回归档中内容相同（大小和摘要都相同）的文件名，没有时返回 None（调用方持有锁）"""
+        if digest is None:
+            return None
+        for name in self.by_size.get(size, ()):
+            if self._digest(name) == digest:
+                return name
+        return None
+
+    def store(self, file_path, digest=None):
+        """把文件移入归档目录，返回 (归档后的路径, 是否与已有文件重复)
+
+        传入 digest 且归档中已有相同内容时不再保存第二份：同名时直接删除原文件，
+        不同名时用硬链接保留新文件名（文件系统不支持硬链接时照常移动）。
+        """
+        size = os.path.getsize(file_path)
+        base_name = os.path.basename(file_path)
+        with self.lock:
+            duplicate = self.find_duplicate(size, digest)
+            if duplicate is not None and os.path.normcase(duplicate) == os.path.normcase(base_name):
+                os.remove(file_path)
+                return os.path.join(self.directory, duplicate), True
+            name = self._free_name(base_name)
+            dest_path = os.path.join(self.directory, name)
+            # 目录可能被其他程序改动，目标已存在时继续找下一个名字，不覆盖已有文件
+            while os.path.exists(dest_path):
+                self.names.add(os.path.normcase(name))
+                name = self._free_name(base_name)
+                dest_path = os.path.join(self.directory, name)
+            linked = False
+            if duplicate is not None:
+                try:
+                    os.link(os.path.join(self.directory, duplicate), dest_path)
+                    os.remove(file_path)
+                    linked = True
+                except OSError as e:
+                    logging.warning(f"Cannot hard link {dest_path} to {duplicate}, storing a copy: {e}")
+            if not linked:
+                os.rename(file_path, dest_path)
+            self._add(name, size)
+            self.digests[name] = digest
+        return dest_path, linked
+
+def move_file(epub_path, success, sent_dir, failed_dir, archives=None, digest=None):
+    """移动文件到成功或失败目录
+
+    传入 archives（{目录: ArchiveIndex}）时由索引分配不重名的文件名，并按 digest 对归档中已有的相同内容去重；
+    否则逐个尝试 名字_1、名字_2……，适合只移动少量文件的场合。
+    """
+    started = time.perf_counter()
     dest_dir = sent_dir if success else failed_dir
     base_name = os.path.basename(epub_path)
-    dest_path = os.path.join(dest_dir, base_name)
-    counter = 1
-    while os.path.exists(dest_path):
-        name, ext = os.path.splitext(base_name)
-        dest_path = os.path.join(dest_dir, f"{name}_{counter}{ext}")
-        counter += 1
-    os.rename(epub_path, dest_path)
-    logging.info(f"Moved: {epub_path} -> {dest_path}")
+    archive = (archives or {}).get(dest_dir)
+    duplicate = False
+    if archive is not None:
+        dest_path, duplicate = archive.store(epub_path, digest)
+    else:
+        dest_path = os.path.join(dest_dir, base_name)
+        counter = 1
+        while os.path.exists(dest_path):
+            name, ext = os.path.splitext(base_name)
+            dest_path = os.path.join(dest_dir, f"{name}_{counter}{ext}")
+            counter += 1
+        os.rename(epub_path, dest_path)
+    if duplicate:
+        logging.info(f"Moved: {epub_path} -> {dest_path} (same content already archived, not stored again)")
+    else:
+        logging.info(f"Moved: {epub_path} -> {dest_path}")
+    log_event("move", file=base_name, success=success, deduplicated=duplicate, seconds=time.perf_counter() - started)
+    return dest_path
+
+class SendJournal:
+    """发送日志（预写式）：按 JSON 行追加记录批次内每个文件的状态，每条记录写入后立即落盘
+
+    状态依次为 queued、sending、delivered/failed、moved。程序崩溃后可据此把已发送但未移动的文件直接归档，
+    并从中断处继续发送。同一时间只记录一个批次，批次结束后清空日志。
+    """
+
+    def __init__(self, path=JOURNAL_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def _append(self, record):
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def begin(self, ebooks_dir, kindle_email, files):
+        """开始新批次（清空旧日志），返回批次 ID"""
+        batch_id = uuid.uuid4().hex
+        with self.lock:
+            open(self.path, "w").close()
+        self._append({"batch": batch_id, "event": "begin", "ebooks_dir": ebooks_dir,
+                      "kindle_email": kindle_email, "files": files, "time": time.time()})
+        return batch_id
+
+    def record(self, batch_id, file, state, **extra):
+        self._append({"batch": batch_id, "file": file, "state": state, "time": time.time(), **extra})
+
+    def end(self, batch_id):
+        """批次结束，清空日志"""
+        with self.lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        logging.info(f"Send journal closed for batch {batch_id}.")
+
+    def pending_batch(self):
+        """重放日志，返回未结束的批次（包括每个文件的最新状态），没有则返回 None"""
+        if not os.path.exists(self.path):
+            return None
+        batch = None
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 崩溃时可能留下写了一半的最后一行
+                    continue
+                if record.get("event") == "begin":
+                    batch = {"id": record["batch"], "ebooks_dir": record["ebooks_dir"],
+                             "kindle_email": record["kindle_email"], "files": record["files"], "states": {}}
+                elif batch is not None and record.get("batch") == batch["id"]:
+                    batch["states"][record["file"]] = record["state"]
+        return batch
+
+def recover_interrupted_batch(journal, index=None):
+    """重放发送日志：已发送但未移动的文件直接归档而不重新发送，发送失败的文件移到失败目录
+
+    返回未完成的批次，其中 remaining 为仍需发送的文件；没有未完成的批次时返回 None。
+    """
+    batch = journal.pending_batch()
+    if batch is None:
+        return None
+    logging.info(f"Recovering interrupted batch {batch['id']} in {batch['ebooks_dir']}.")
+    sent_dir, failed_dir = setup_directories(batch["ebooks_dir"])
+    remaining = []
+    for file in batch["files"]:
+        state = batch["states"].get(file, "queued")
+        file_path = os.path.join(batch["ebooks_dir"], file)
+        if state == "moved" or not os.path.exists(file_path):
+            continue
+        if state in ("delivered", "failed"):
+            dest_path = move_file(file_path, state == "delivered", sent_dir, failed_dir)
+            journal.record(batch["id"], file, "moved", dest=dest_path)
+            continue
+        if state == "sending":
+            # 无法确定上次是否已发送成功，只能重新发送
+            logging.warning(f"{file} was being sent when the batch was interrupted, it will be sent again.")
+        remaining.append(file)
+    batch["remaining"] = remaining
+    if not remaining:
+        journal.end(batch["id"])
+    return batch
+
+class TransferProgress:
+    """按字节统计整批文件的上传进度（线程安全）：已完成的文件按其编码后的大小计入，正在上传的邮件按实际写入网络的字节计入
+
+    total_bytes 为整个队列编码后的总字节数，进度和剩余时间按文件大小加权，一个大文件不会让进度条长时间停住。
+    当前速度取最近 window 秒的平均值，平均速度从第一次写入数据开始计算；
+    add() 最多每 interval 秒返回一次进度快照，调用方只在拿到快照时发送进度事件。
+    """
+
+    def __init__(self, total_bytes, interval=PROGRESS_UPDATE_INTERVAL, window=THROUGHPUT_WINDOW):
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.window = window
+        self.done_bytes = 0
+        self.in_flight_bytes = 0
+        self.uploaded_bytes = 0
+        self.started = None
+        self.last_report = 0
+        self.samples = collections.deque()
+        self._lock = threading.Lock()
+
+    def add(self, nbytes):
+        """记录写入网络的字节数，到了报告间隔时返回进度快照，否则返回 None"""
+        with self._lock:
+            now = time.monotonic()
+            if self.started is None:
+                # 第一块数据写入时还算不出速度，下一个报告间隔再报告
+                self.started = self.last_report = now
+                self.samples.append((now, 0))
+            self.uploaded_bytes += nbytes
+            self.in_flight_bytes += nbytes
+            self.samples.append((now, self.uploaded_bytes))
+            while len(self.samples) > 2 and self.samples[1][0] < now - self.window:
+                self.samples.popleft()
+            if now - self.last_report < self.interval:
+                return None
+            self.last_report = now
+            return self._snapshot(now)
+
+    def settle(self, uploaded, completed=0):
+        """一次发送尝试结束：去掉其正在上传的字节，completed 为随之完成的文件的字节数（失败时为 0，重试会重新计入）"""
+        with self._lock:
+            self.in_flight_bytes -= uploaded
+            self.done_bytes += completed
+
+    def complete(self, nbytes):
+        """文件处理完（跳过、无效或放弃重试）但没有经过 settle() 时，把它的字节数计为已完成"""
+        with self._lock:
+            self.done_bytes += nbytes
+
+    def snapshot(self):
+        with self._lock:
+            return self._snapshot(time.monotonic())
+
+    def _snapshot(self, now):
+        sent_bytes = min(self.done_bytes + self.in_flight_bytes, self.total_bytes)
+        average_rate = current_rate = 0.0
+        if self.started is not None and now > self.started:
+            average_rate = self.uploaded_bytes / (now - self.started)
+            first_time, first_bytes = self.samples[0]
+            # 最近一段时间没有写入数据（等待服务器回复或限速）时速度随时间下降
+            if now > first_time:
+                current_rate = (self.uploaded_bytes - first_bytes) / (now - first_time)
+        rate = current_rate or average_rate
+        remaining = self.total_bytes - sent_bytes
+        return {
+            "percent": sent_bytes / self.total_bytes * 100 if self.total_bytes else 100.0,
+            "sent_bytes": sent_bytes,
+            "total_bytes": self.total_bytes,
+            "current_rate": current_rate,
+            "average_rate": average_rate,
+            "eta": remaining / rate if rate > 0 else None,
+        }
+
+def format_transfer(progress):
+    """把进度快照格式化为一行文字，例如：已上传 12.3/40.0 MB，当前 2.10 MB/s，平均 1.85 MB/s，剩余约 0:15"""
+    mb = 1024 * 1024
+    text = (f"已上传 {progress['sent_bytes'] / mb:.1f}/{progress['total_bytes'] / mb:.1f} MB，"
+            f"当前 {progress['current_rate'] / mb:.2f} MB/s，平均 {progress['average_rate'] / mb:.2f} MB/s")
+    if progress["eta"] is not None:
+        minutes, seconds = divmod(int(progress["eta"] + 0.5), 60)
+        hours, minutes = divmod(minutes, 60)
+        text += f"，剩余约 {hours}:{minutes:02d}:{seconds:02d}" if hours else f"，剩余约 {minutes}:{seconds:02d}"
+    return text
+
+class SendEngine:
+    """后台发送引擎：在工作线程中处理文件队列，通过线程安全的事件队列报告状态和进度，支持暂停和取消
+
+    事件为 (类型, 数据) 元组，类型包括 status、progress、error、resume 和 done（done 的 files 为本批次的文件数）。
+    files 为 None 时在发送线程中恢复中断的批次并扫描目录：上次未完成的批次与本次目录和收件人相同时发送 resume 事件，
+    由调用方通过 answer_resume() 回答是否继续；目录中没有可发送的文件时直接发送 files 为 0 的 done 事件。
+    progress 的数据是 TransferProgress 的快照（按字节计算的进度、上传速度和剩余时间），上传期间定时发送，每个文件处理完时也发送一次。
+    按提供商限速配置开启多个并行 SMTP 连接，超出额度的文件排队等待下一个时间窗口。
+    每个文件的状态写入 SendJournal；传入 batch_id 时继续之前中断的批次。
+    发送失败时按 RetryPolicy 分类处理：永久错误直接归入失败，临时故障和限流放入延后队列，
+    认证失败立即停止批次，连续失败时由 CircuitBreaker 暂停整个提供商。
+    传入 accounts（SenderAccount 列表）时使用账号池：每个账号按自己的限速开启连接，各连接从同一队列取文件，
+    额度多的账号自然发得多；某个账号被限流、额度用完或认证失败时，它的文件交给其他账号发送。
+    传入启用的 optimize 选项（见 EPUB_OPTIMIZE_DEFAULTS）时，发送前在进程池中压缩较大的 EPUB，上传压缩后的缓存文件；
+    传入启用的 convert 选项（见 CONVERT_DEFAULTS）时，先把 TXT、Markdown 和 HTML 文档转换为 EPUB 再发送。
+    不依赖 Tk，也可以直接调用 run() 在当前线程中同步运行。
+    """
+
+    def __init__(self, files, ebooks_dir, email_provider, email_username, email_password, kindle_email,
+                 max_messages=DEFAULT_MAX_MESSAGES_PER_CONNECTION, events=None, limits=None, index=None,
+                 journal=None, batch_id=None, retry_policy=None, quota_path=QUOTA_FILE, accounts=None, optimize=None,
+                 convert=None):
+        self.files = files
+        self.ebooks_dir = ebooks_dir
+        self.email_provider = email_provider
+        self.email_username = email_username
+        self.email_password = email_password
+        self.kindle_email = kindle_email
+        self.recipients = parse_recipients(kindle_email)
+        self.max_messages = max_messages
+        self.events = events if events is not None else queue.Queue()
+        self.accounts = accounts or [SenderAccount(email_provider, email_username, email_password, limits,
+                                                   quota_path=quota_path)]
+        # 装箱按所有账号中最严格的限制进行，任何账号都能发送任意一箱
+        self.max_message_bytes = min(account.limits["max_message_bytes"] for account in self.accounts)
+        self.max_attachments = min(account.limits["max_attachments"] for account in self.accounts)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.optimize = optimize if optimize and optimize.get("enabled") else None
+        self.convert = convert if convert and convert.get("enabled") else None
+        self.index = index
+        self.journal = journal if journal is not None else SendJournal()
+        self.batch_id = batch_id
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+        self.thread = None
+        self._lock = threading.Lock()
+        self._cancel_event = threading.Event()
+        self._resume_event = threading.Event()
+        self._resume_event.set()
+        # 是否继续上次中断的批次（answer_resume 的回答）
+        self._resume_answer = queue.Queue()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    @property
+    def paused(self):
+        return not self._resume_event.is_set()
+
+    def start(self):
+        """在后台线程中开始发送"""
+        self.thread = threading.Thread(target=self.run, name="SendEngine", daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def pause(self):
+        self._resume_event.clear()
+        self.post("status", text="已暂停")
+        logging.info("Sending paused.")
+
+    def resume(self):
+        self._resume_event.set()
+        self.post("status", text="发送中...")
+        logging.info("Sending resumed.")
+
+    def answer_resume(self, resume):
+        """回答 resume 事件：True 继续上次中断的批次，False 放弃并重新扫描目录"""
+        self._resume_answer.put(resume)
+
+    def cancel(self):
+        self._cancel_event.set()
+        self._resume_event.set()
+        # 正在等待 resume 的回答时不再等待
+        self._resume_answer.put(False)
+        self.post("status", text="正在取消...")
+        logging.info("Sending cancelled.")
+
+    def post(self, kind, **data):
+        self.events.put((kind, data))
+
+    def wait(self, seconds):
+        """可被取消打断的等待，返回 False 表示已取消"""
+        return not self._cancel_event.wait(seconds)
+
+    def checkpoint(self):
+        """暂停时阻塞，直到继续或取消，返回 False 表示已取消"""
+        self._resume_event.wait()
+        return not self.cancelled
+
+    def run(self):
+        if self.files is None:
+            try:
+                self.files = self._collect_files()
+            except Exception as e:
+                logging.exception(f"Failed to prepare the batch: {e}")
+                self.post("error", message=f"扫描电子书目录时出现错误：{e}")
+                self.files = []
+            if not self.files or self.cancelled:
+                self.post("status", text="已取消" if self.cancelled else "未连接")
+                self.post("done", connected=False, cancelled=self.cancelled, sent=0, failed=0, skipped=0, files=0)
+                return
+        sessions = [
+            (account, account.new_session(self.max_messages))
+            for account in self.accounts
+            for _ in range(max(1, min(account.limits["connections"], len(self.files))))
+        ]
+        connected = False
+        own_index = self.index is None
+        started = time.perf_counter()
+        log_event("batch_start", files=len(self.files), recipients=len(self.recipients), accounts=len(self.accounts),
+                  connections=len(sessions))
+        try:
+            if own_index:
+                self.index = FileIndex()
+            self.post("status", text="连接中...")
+            if not self._preflight(sessions):
+                self.post("status", text="连接失败")
+                return
+            connected = True
+            sessions = [(account, session) for account, session in sessions if not account.disabled]
+            self.post("status", text="连接成功")
+            if self.batch_id is None:
+                self.batch_id = self.journal.begin(self.ebooks_dir, self.kindle_email, self.files)
+            self.send_files(sessions)
+            self.journal.end(self.batch_id)
+        except Exception as e:
+            logging.exception(f"Sending aborted: {e}")
+            self.post("error", message=f"发送过程中出现错误：{e}")
+        finally:
+            for _, session in sessions:
+                session.close()
+            if own_index and self.index is not None:
+                self.index.close()
+                self.index = None
+            log_event("batch_end", batch=self.batch_id, connected=connected, sent=self.sent, failed=self.failed,
+                      skipped=self.skipped, cancelled=self.cancelled, seconds=time.perf_counter() - started)
+            self.post("done", connected=connected, cancelled=self.cancelled, sent=self.sent, failed=self.failed,
+                      skipped=self.skipped, files=len(self.files))
+
+    def _collect_files(self):
+        """恢复中断的批次（已发送的文件直接归档），返回要发送的文件：继续上次的批次时为其剩余文件，否则重新扫描目录"""
+        self.post("status", text="正在扫描目录...")
+        batch = recover_interrupted_batch(self.journal)
+        if batch is not None and batch["remaining"]:
+            same_target = (os.path.abspath(batch["ebooks_dir"]) == os.path.abspath(self.ebooks_dir)
+                           and batch["kindle_email"] == self.kindle_email)
+            if same_target:
+                self.post("resume", remaining=len(batch["remaining"]))
+                if self._resume_answer.get():
+                    self.batch_id = batch["id"]
+                    return batch["remaining"]
+            self.journal.end(batch["id"])
+        return scan_ebooks(self.ebooks_dir, self.convert is not None)
+
+    def _preflight(self, sessions):
+        """检查每个账号能否连接和登录，成功的连接直接用于发送（同一账号的其余会话在首次发送时再连接）
+
+        连接失败的账号本批次停用；全部失败时报告第一个账号的错误并返回 False。
+        """
+        first_error = None
+        for account in self.accounts:
+            session = next(session for owner, session in sessions if owner is account)
+            ok, error = check_smtp_connection(account.email_provider, account.email_username, account.email_password,
+                                              session=session)
+            # 每个批次重新检查，之前停用的账号恢复后可以再次使用
+            account.disabled = not ok
+            if not ok:
+                first_error = first_error or error
+                logging.error(f"Account {account} is not usable for this batch.")
+        if all(account.disabled for account in self.accounts):
+            self.post("error", message=first_error)
+            return False
+        if first_error is not None:
+            disabled = "、".join(account.email_username for account in self.accounts if account.disabled)
+            self.post("status", text=f"以下账号无法连接，改用其他账号发送：{disabled}")
+        return True
+
+    def send_files(self, sessions):
+        """用多个 SMTP 连接并行发送，每个账号的连接共用该账号的限速器；小文件按提供商限制装箱，多本书合并成一封邮件
+
+        sessions 为 [(SenderAccount, SMTPSession), ...]。
+        """
+        sent_dir, failed_dir = setup_directories(self.ebooks_dir)
+        log_name = os.path.basename(LOG_FILE)
+        files = [file for file in self.files if file != log_name]
+        # {原文件路径: 转换或压缩后的缓存文件}，装箱、限速和进度都按实际上传的文件计算
+        self._upload_paths = {}
+        if self.convert:
+            self._upload_paths.update(self._convert_documents(files))
+        if self.optimize and not self.cancelled:
+            self._upload_paths.update(self._optimize_epubs(files))
+        if self.cancelled:
+            return
+        file_sizes = {}
+        for file in files:
+            file_path = os.path.join(self.ebooks_dir, file)
+            try:
+                file_sizes[file] = os.path.getsize(self._upload_paths.get(file_path, file_path))
+            except OSError:
+                # 文件已不存在，交给后续处理记为失败
+                file_sizes[file] = 0
+        self.total_files = len(file_sizes)
+        self.done_files = 0
+        # 进度按每个文件编码后要上传的字节数加权
+        self._wire_sizes = {file: base64_encoded_size(size) + ATTACHMENT_OVERHEAD_BYTES for file, size in file_sizes.items()}
+        self.transfer = TransferProgress(sum(self._wire_sizes.values()))
+        self._pending = collections.deque(pack_files(file_sizes, self.max_message_bytes, self.max_attachments))
+        self._prepared = collections.deque()
+        self._prefetch_depth = len(sessions) * PREFETCH_MESSAGES_PER_CONNECTION
+        self._deferred = []
+        self._deferred_seq = 0
+        self._in_flight = 0
+        # 有文件重新排队或处理完时通知空闲的发送线程
+        self._work_changed = threading.Condition(self._lock)
+
+        # 验证（计算摘要、检查结构）在线程池中提前进行，与网络上传重叠；读文件和计算摘要时会释放 GIL
+        self._prefetcher = ThreadPoolExecutor(max_workers=len(sessions), thread_name_prefix="Prefetch")
+        self._archive_dirs = (sent_dir, failed_dir)
+        # 归档目录每个批次只扫描一次，之后移动文件不再遍历目录
+        self._archives = {directory: ArchiveIndex(directory, self.index) for directory in self._archive_dirs}
+        workers = [
+            threading.Thread(target=self._worker, args=(account, session, sent_dir, failed_dir),
+                             name=f"SendWorker-{n}", daemon=True)
+            for n, (account, session) in enumerate(sessions)
+        ]
+        try:
+            with self._lock:
+                self._prefetch()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            self._prefetcher.shutdown(cancel_futures=True)
+        self.post("status", text="已取消" if self.cancelled else "发送完成")
+
+    def _run_stage(self, event, label, function, file_paths, *args):
+        """在进程池中（每个 CPU 核心一个进程）对每个文件调用 function(文件路径, *args)，返回 {文件路径: 结果}
+
+        结果写入事件日志；出错的文件记录警告后跳过，取消时不再等待其余文件。
+        """
+        # 进程池只在启用压缩或转换时用到，按需导入以加快启动
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        self.post("status", text=f"正在{label}（0/{len(file_paths)}）...")
+        results = {}
+        with ProcessPoolExecutor(max_workers=min(len(file_paths), os.cpu_count() or 1)) as pool:
+            futures = {pool.submit(function, file_path, *args): file_path for file_path in file_paths}
+            for done, future in enumerate(as_completed(futures), 1):
+                if self.cancelled:
+                    pool.shutdown(cancel_futures=True)
+                    break
+                file_path = futures[future]
+                try:
+                    results[file_path] = future.result()
+                except Exception as e:
+                    logging.warning(f"Failed to {event} {file_path}: {e}")
+                    continue
+                log_event(event, file=os.path.relpath(file_path, self.ebooks_dir), **results[file_path])
+                self.post("status", text=f"正在{label}（{done}/{len(file_paths)}）...")
+        return results
+
+    def _convert_documents(self, files):
+        """把 TXT、Markdown 和 HTML 文档转换为 EPUB，返回 {原文件路径: 转换后的 EPUB}
+
+        已转换过的文档直接使用缓存；转换失败的 TXT 和 HTML 照原样发送，Markdown 归入失败。
+        """
+        candidates = [os.path.join(self.ebooks_dir, file) for file in files
+                      if os.path.splitext(file)[1].lower().lstrip(".") in CONVERTIBLE_FORMATS]
+        if not candidates:
+            return {}
+        results = self._run_stage("convert", "转换文档", convert_document, candidates, CONVERT_CACHE_DIR, self.convert)
+        for file_path, result in results.items():
+            logging.info(f"Converted {file_path} to EPUB ({result['converted_bytes'] / 1024:.0f} KB)"
+                         f"{' (cached)' if result['cached'] else ''}")
+        if results:
+            self.post("status", text=f"已把 {len(results)} 个文档转换为 EPUB")
+        return {file_path: result["path"] for file_path, result in results.items()}
+
+    def _optimize_epubs(self, files):
+        """压缩不小于 min_size 的 EPUB，返回 {原文件路径: 压缩后的缓存文件}
+
+        已压缩过的书直接使用缓存；压缩失败或效果不明显的书照原样发送。
+        """
+        candidates = []
+        for file in files:
+            file_path = os.path.join(self.ebooks_dir, file)
+            try:
+                if file.lower().endswith(".epub") and os.path.getsize(file_path) >= self.optimize["min_size"]:
+                    candidates.append(file_path)
+            except OSError:
+                continue
+        if not candidates:
+            return {}
+        import importlib.util
+        if self.optimize.get("max_image_side") and importlib.util.find_spec("PIL") is None:
+            logging.warning("Pillow is not installed, EPUB images will not be downsampled.")
+        results = self._run_stage("optimize", "压缩 EPUB", optimize_epub, candidates, OPTIMIZE_CACHE_DIR, self.optimize)
+        upload_paths = {}
+        saved = 0
+        for file_path, result in results.items():
+            if result["path"] is not None:
+                logging.info(f"Optimized {file_path}: {result['bytes'] / (1024 * 1024):.2f} MB -> "
+                             f"{result['optimized_bytes'] / (1024 * 1024):.2f} MB{' (cached)' if result['cached'] else ''}")
+                upload_paths[file_path] = result["path"]
+                saved += result["bytes"] - result["optimized_bytes"]
+        if upload_paths:
+            self.post("status", text=f"已压缩 {len(upload_paths)} 个 EPUB，共减少 {saved / (1024 * 1024):.1f} MB")
+        return upload_paths
+
+    def _worker(self, account, session, sent_dir, failed_dir):
+        while self.checkpoint() and not account.disabled:
+            if account.unavailable_for() > 0 and self._other_account_ready(account):
+                # 本账号暂停期间不取文件，由其他账号发送
+                with self._lock:
+                    if not (self._prepared or self._deferred or self._in_flight):
+                        return
+                    self._work_changed.wait(WORKER_IDLE_POLL_INTERVAL)
+                continue
+            task = self._next_task()
+            if task is None:
+                return
+            files, group, attempt = task
+            try:
+                if isinstance(group, Future):
+                    group = group.result()
+                if group and not self._send_group(group, attempt, account, session, sent_dir, failed_dir):
+                    return
+            except Exception as e:
+                logging.exception(f"Failed to process {', '.join(files)}: {e}")
+                self.transfer.complete(sum(self._wire_sizes.get(file, 0) for file in files))
+                with self._lock:
+                    self.failed += len(files)
+                    self.done_files += len(files)
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+                    self._work_changed.notify_all()
+
+    def _next_task(self):
+        """取下一组文件：先取已提前验证的新文件，没有时取延后重试的文件（等到其重试时间）
+
+        新文件的验证结果是 Future，由调用方等待。其他连接还有文件在发送时（失败后可能重新排队）继续等待，
+        全部处理完或已取消时返回 None。取到的任务处理完后调用方需把 _in_flight 减一。
+        """
+        while True:
+            with self._lock:
+                if self._prepared:
+                    files, future = self._prepared.popleft()
+                    self._prefetch()
+                    self._in_flight += 1
+                    return files, future, 0
+                if self._deferred:
+                    ready_at, _, attempt, group = heapq.heappop(self._deferred)
+                    self._in_flight += 1
+                    break
+                if not self._in_flight:
+                    return None
+                self._work_changed.wait(WORKER_IDLE_POLL_INTERVAL)
+            if self.cancelled:
+                return None
+        if not self.wait(max(0, ready_at - time.monotonic())):
+            for file, _, _ in group:
+                self.journal.record(self.batch_id, file, "queued")
+            with self._lock:
+                self._in_flight -= 1
+                self._work_changed.notify_all()
+            return None
+        return [file for file, _, _ in group], group, attempt
+
+    def _other_account_ready(self, account):
+        """账号池中是否有其他账号现在就能发送"""
+        return any(other is not account and not other.disabled and not other.unavailable_for()
+                   and not other.limiter.delay() for other in self.accounts)
+
+    def _prefetch(self):
+        """把待发送的文件组提交给线程池验证，已提交未取走的不超过 _prefetch_depth 组，内存占用有上限（调用方持有 _lock）"""
+        while self._pending and len(self._prepared) < self._prefetch_depth:
+            files = self._pending.popleft()
+            self._prepared.append((files, self._prefetcher.submit(self._validate, files, *self._archive_dirs)))
+
+    def _defer(self, group, attempt, delay):
+        """放入延后重试队列，不阻塞批次中的其他文件"""
+        with self._lock:
+            self._deferred_seq += 1
+            heapq.heappush(self._deferred, (time.monotonic() + delay, self._deferred_seq, attempt, group))
+            self._work_changed.notify_all()
+        for file, _, _ in group:
+            self.journal.record(self.batch_id, file, "queued")
+
+    def _validate(self, files, sent_dir, failed_dir):
+        """验证一组文件，无效的移入失败目录，已发送给所有收件人的直接归档，
+        返回待发送的 [(文件, 摘要, 还没收到的收件人), ...]"""
+        group = []
+        for file in files:
+            file_path = os.path.join(self.ebooks_dir, file)
+            started = time.perf_counter()
+            file_format, digest = self.index.inspect(file_path)
+            log_event("validate", file=file, format=file_format, seconds=time.perf_counter() - started)
+            if file_format is None:
+                logging.error(f"Invalid or unsupported file: {file_path}")
+                self._finish(file, False, sent_dir, failed_dir)
+                continue
+            pending = [r for r in self.recipients if self.index.delivered_as(digest, r) is None]
+            recipients = tuple(r for r in pending if self.index.refused_as(digest, r) is None)
+            if not recipients and len(pending) == len(self.recipients):
+                # 所有收件人此前都已永久拒收这本书，不再发送，计为失败
+                logging.error(f"Not sending {file_path}: permanently refused by {', '.join(pending)}")
+                self.post("status", text=f"{file} 的收件人此前已永久拒收，不再发送")
+                self._finish(file, False, sent_dir, failed_dir, digest=digest)
+                continue
+            if not recipients:
+                # 同一内容已发送过（可能是重新放入或改名的副本），其余收件人此前已永久拒收，不再重复发送
+                logging.info(f"Skipped: {file_path} has already been sent to "
+                             f"{', '.join(r for r in self.recipients if r not in pending)}")
+                self._finish(file, True, sent_dir, failed_dir, skipped=True, digest=digest)
+                continue
+            group.append((file, digest, recipients))
+        return group
+
+    def _send_group(self, group, attempt, account, session, sent_dir, failed_dir):
+        """用 account 把一组文件作为一封邮件发送一次，失败时按错误类型延后重试、交给其他账号或归入失败，
+        返回 False 表示该连接应停止（已取消或账号已停用）"""
+        while (breaker_delay := account.breaker.delay()) > 0:
+            self.post("status", text=f"服务器连续拒绝发送，暂停 {breaker_delay:.0f} 秒后重试...")
+            if not self.wait(min(breaker_delay, 60)):
+                break
+        recipients = group[0][2]
+        if any(item[2] != recipients for item in group):
+            # 合并的书此前已送达的收件人不同（部分收件人失败后重试），按书拆开分别发送
+            for item in group:
+                self._defer([item], attempt, 0)
+            return True
+        file_paths = [os.path.join(self.ebooks_dir, file) for file, _, _ in group]
+        total_bytes = sum(os.path.getsize(self._upload_paths.get(file_path, file_path)) for file_path in file_paths)
+        delay, quota_exhausted = account.limiter.try_acquire(total_bytes, len(recipients))
+        if delay > 0 and self._other_account_ready(account):
+            # 本账号额度不足，文件立即交给其他账号，本账号等额度恢复后再取文件
+            logging.info(f"Account {account} rate limited for {delay:.1f}s, handing {group[0][0]} to another account.")
+            account.throttled_until = time.monotonic() + delay
+            self._defer(group, attempt, 0)
+            return True
+        if self.cancelled or (delay > 0 and not account.limiter.acquire(total_bytes, self.wait, self._on_rate_limited,
+                                                                      len(recipients))):
+            for file, _, _ in group:
+                self.journal.record(self.batch_id, file, "queued")
+            return False
+        first = group[0][0]
+        logging.info(f"Sending: {', '.join(file for file, _, _ in group)}, Size: {total_bytes / (1024 * 1024):.2f} MB"
+                     f", Account: {account}")
+        label = first if len(group) == 1 else f"{first} 等 {len(group)} 个文件"
+        status = f"正在发送（{self.done_files + 1}/{self.total_files}）：{label}"
+        if len(self.accounts) > 1:
+            status += f"（{account.email_username}）"
+        self.post("status", text=status)
+        for file, _, _ in group:
+            self.journal.record(self.batch_id, file, "sending")
+        uploaded = 0
+
+        def on_progress(nbytes):
+            nonlocal uploaded
+            uploaded += nbytes
+            progress = self.transfer.add(nbytes)
+            if progress is not None:
+                self.post("progress", **progress)
+
+        try:
+            refused = deliver_books(file_paths, account.email_username, recipients, session, self.index, on_progress,
+                                    self._upload_paths)
+        except Exception as e:
+            # 失败的上传不计入进度，重试时重新计算
+            self.transfer.settle(uploaded)
+            session.reset()
+            error_class = classify_smtp_error(e)
+            logging.error(f"Failed to send {label} via {account} (attempt {attempt + 1}/{self.retry_policy.max_attempts}, "
+                          f"{error_class}): {e}")
+            log_event("send_failed", files=[file for file, _, _ in group], user=account.email_username,
+                      attempt=attempt + 1, error=type(e).__name__, error_class=error_class,
+                      code=getattr(e, "smtp_code", None))
+            if not isinstance(e, smtplib.SMTPRecipientsRefused) or error_class == THROTTLED:
+                # 收件人被拒收是收件人的问题，不算作服务器故障
+                account.breaker.record_failure(error_class)
+            if isinstance(e, smtplib.SMTPRecipientsRefused):
+                permanent = self._record_refusals(group, e.recipients)
+                recipients = tuple(r for r in recipients if r not in permanent)
+                if not recipients:
+                    # 所有收件人都永久拒收，拆开或重试都没有用
+                    for file, digest, _ in group:
+                        self._give_up(file, digest, sent_dir, failed_dir)
+                    return True
+                # 只对临时拒收的收件人重试
+                group = [(file, digest, recipients) for file, digest, _ in group]
+                if permanent:
+                    error_classes = [_classify_reply(*reply) for address, reply in e.recipients.items()
+                                     if address not in permanent]
+                    error_class = THROTTLED if THROTTLED in error_classes else TRANSIENT
+            if isinstance(e, smtplib.SMTPAuthenticationError):
+                # 认证失败对该账号的所有文件都一样：停用该账号，文件交给其他账号；没有其他账号时停止整个批次，文件留在原处
+                account.disabled = True
+                if any(not other.disabled for other in self.accounts):
+                    self.post("status", text=f"{account.email_username} 认证失败，改用其他账号发送")
+                    self._defer(group, attempt, 0)
+                    return False
+                for file, _, _ in group:
+                    self.journal.record(self.batch_id, file, "queued")
+                self.post("error", message=f"{account.email_provider} SMTP 认证失败，已停止发送。\n错误详情：{e}")
+                self.cancel()
+                return False
+            if error_class == THROTTLED and self._other_account_ready(account):
+                # 服务器限流只针对本账号，不计入重试次数，立即交给其他账号
+                account.throttled_until = time.monotonic() + self.retry_policy.delay(attempt, error_class)
+                logging.warning(f"Account {account} throttled, handing {label} to another account.")
+                self._defer(group, attempt, 0)
+                return True
+            if len(group) > 1:
+                # 合并的邮件失败后拆开逐个发送，避免一本书的问题连累其他书
+                logging.warning(f"Packed message of {len(group)} files failed, sending them one by one.")
+                delay = 0 if error_class == PERMANENT else self.retry_policy.delay(attempt, error_class)
+                for item in group:
+                    self._defer([item], attempt, delay)
+                return True
+            if self.retry_policy.should_retry(attempt, error_class):
+                delay = self.retry_policy.delay(attempt, error_class)
+                logging.warning(f"Retrying {first} in {delay:.0f}s.")
+                self._defer(group, attempt + 1, delay)
+                return True
+            self._give_up(first, group[0][1], sent_dir, failed_dir)
+            return True
+        account.breaker.record_success()
+        for file, digest, _ in group:
+            for recipient in recipients:
+                if recipient not in refused:
+                    self.index.mark_delivered(digest, recipient, file)
+        if refused:
+            # 只对拒收的收件人重试，已收到的不会重复发送；永久拒收的收件人放弃，书仍算发送成功
+            error_classes = {address: _classify_reply(code, resp) for address, (code, resp) in refused.items()}
+            self._record_refusals(group, refused)
+            retry = tuple(address for address in recipients if error_classes.get(address, PERMANENT) != PERMANENT)
+            error_class = THROTTLED if THROTTLED in error_classes.values() else TRANSIENT
+            if retry and self.retry_policy.should_retry(attempt, error_class):
+                delay = self.retry_policy.delay(attempt, error_class)
+                logging.warning(f"Retrying {label} for {', '.join(retry)} in {delay:.0f}s.")
+                self.transfer.settle(uploaded)
+                self._defer([(file, digest, retry) for file, digest, _ in group], attempt + 1, delay)
+                return True
+        # 上传的字节换成这些文件的字节数一次计入，进度不会来回跳动
+        self.transfer.settle(uploaded, sum(self._wire_sizes.get(file, 0) for file, _, _ in group))
+        for file, digest, _ in group:
+            self.journal.record(self.batch_id, file, "delivered")
+            self._finish(file, True, sent_dir, failed_dir, counted=True, digest=digest)
+        return True
+
+    def _record_refusals(self, group, refused):
+        """记录永久拒收的收件人（refused 为 {地址: (代码, 回复)}），返回这些地址的集合"""
+        permanent = {address for address, (code, resp) in refused.items() if _classify_reply(code, resp) == PERMANENT}
+        for _, digest, _ in group:
+            for address in permanent:
+                self.index.mark_refused(digest, address, refused[address][0])
+        return permanent
+
+    def _give_up(self, file, digest, sent_dir, failed_dir):
+        """放弃发送：此前已送达部分收件人（这次只重试其余收件人）时仍算发送成功"""
+        delivered = any(self.index.delivered_as(digest, r) is not None for r in self.recipients)
+        if delivered:
+            self.journal.record(self.batch_id, file, "delivered")
+        self._finish(file, delivered, sent_dir, failed_dir, digest=digest)
+
+    def _finish(self, file, success, sent_dir, failed_dir, skipped=False, counted=False, digest=None):
+        """归档处理完的文件并更新计数；counted 表示其字节数已随 TransferProgress.settle() 计入进度，
+        digest 用于在归档目录中对相同内容去重"""
+        if not counted:
+            self.transfer.complete(self._wire_sizes.get(file, 0))
+        if skipped and success:
+            self.journal.record(self.batch_id, file, "delivered")
+        elif not success:
+            self.journal.record(self.batch_id, file, "failed")
+        dest_path = move_file(os.path.join(self.ebooks_dir, file), success, sent_dir, failed_dir, self._archives, digest)
+        self.journal.record(self.batch_id, file, "moved", dest=dest_path)
+        with self._lock:
+            if skipped:
+                self.skipped += 1
+            elif success:
+                self.sent += 1
+            else:
+                self.failed += 1
+            self.done_files += 1
+        self.post("progress", **self.transfer.snapshot())
+
+    def _on_rate_limited(self, delay, quota_exhausted):
+        if quota_exhausted:
+            resume_at = time.strftime("%m-%d %H:%M", time.localtime(time.time() + delay))
+            self.post("status", text=f"已达到每日发送额度，剩余文件将在 {resume_at} 后继续发送")
+        else:
+            self.post("status", text=f"发送速度受限，等待 {delay:.0f} 秒...")
+
+def run_headless(engine):
+    """在后台线程运行发送引擎，当前线程把事件输出到终端，返回 done 事件的数据（Ctrl+C 取消发送）
+
+    上传进度在终端中原地刷新同一行；输出重定向到文件时每隔 HEADLESS_PROGRESS_INTERVAL 秒打印一行。
+    """
+    interactive = sys.stdout.isatty()
+    progress_width = 0
+    last_printed = 0
+    engine.start()
+    while True:
+        try:
+            kind, data = engine.events.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        except KeyboardInterrupt:
+            engine.cancel()
+            continue
+        if kind == "progress":
+            text = format_transfer(data)
+            if interactive:
+                # 中文字符在终端中占两列，用空格盖住上一行较长的部分
+                width = sum(2 if ord(c) > 0x7f else 1 for c in text)
+                print(f"\r{text}{' ' * (progress_width - width)}", end="", flush=True)
+                progress_width = width
+            elif time.monotonic() - last_printed >= HEADLESS_PROGRESS_INTERVAL:
+                print(text, flush=True)
+                last_printed = time.monotonic()
+            continue
+        if progress_width:
+            # 进度行之后换行再输出其他消息
+            print(flush=True)
+            progress_width = 0
+        if kind == "status":
+            print(data["text"], flush=True)
+        elif kind == "error":
+            print(data["message"], file=sys.stderr, flush=True)
+        elif kind == "done":
+            engine.thread.join()
+            return data
+
+class _Inotify:
+    """通过 ctypes 调用 Linux inotify，只关心被监视的目录是否有文件或子目录新增、写完、移入或移出"""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+
+    def __init__(self, directory):
+        # 只有监视模式用到，按需导入以加快启动
+        import ctypes
+        import ctypes.util
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        try:
+            self.add(directory)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def add(self, directory):
+        """监视一个目录（已经在监视的目录重复添加不会产生新的监视）"""
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        if self.libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            raise OSError(self.ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+
+    def wait(self, timeout):
+        """等待目录事件，返回是否有事件发生（timeout 为 None 时一直等待）"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+class DirectoryWatcher:
+    """监视电子书目录（包括子目录，与 send 的扫描范围相同）中的新文件，只交出大小和修改时间在 settle_time 秒内不再变化的文件
+
+    Linux 下使用 inotify 监视每一层目录，目录空闲时完全阻塞；其他平台按 poll_interval 轮询各目录的修改时间，
+    只有目录变化时才重新扫描，平时只检查尚未稳定的文件。返回的是相对于电子书目录的路径。
+    """
+
+    def __init__(self, directory, settle_time=WATCH_SETTLE_SECONDS, poll_interval=WATCH_POLL_INTERVAL, convert=False):
+        self.directory = directory
+        # 开启文档转换时也监视 Markdown 文件
+        self.convert = convert
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        # 尚未交出的文件：相对路径 -> (大小, 修改时间, 最近一次变化的时间)
+        self.pending = {}
+        self.dirty = True
+        # 上次扫描时各目录的修改时间，轮询时用来判断是否需要重新扫描
+        self.dir_mtimes = {}
+        self.inotify = None
+        if sys.platform.startswith("linux"):
+            try:
+                self.inotify = _Inotify(directory)
+            except (OSError, AttributeError) as e:
+                logging.warning(f"inotify unavailable, falling back to polling: {e}")
+
+    def _scan(self):
+        now = time.monotonic()
+        directories = []
+        seen = set()
+        for entry in walk_ebooks(self.directory, self.convert, directories):
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            name = os.path.relpath(entry.path, self.directory)
+            seen.add(name)
+            self._update(name, st, now)
+        for name in set(self.pending) - seen:
+            del self.pending[name]
+        self.dir_mtimes = {}
+        for directory in directories:
+            try:
+                self.dir_mtimes[directory] = os.stat(directory).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            if self.inotify is not None:
+                # 新出现的子目录也要监视；目录删除后内核会自动移除对应的监视
+                try:
+                    self.inotify.add(directory)
+                except OSError as e:
+                    logging.warning(f"Failed to watch {directory}: {e}")
+
+    def _update(self, name, st, now):
+        signature = (st.st_size, st.st_mtime_ns)
+        previous = self.pending.get(name)
+        if previous is None or previous[:2] != signature:
+            self.pending[name] = signature + (now,)
+
+    def _refresh_pending(self):
+        now = time.monotonic()
+        for name in list(self.pending):
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                del self.pending[name]
+                continue
+            self._update(name, st, now)
+
+    def take_ready(self):
+        """返回已经稳定的文件（之后不再重复返回，除非它们重新出现在目录中）"""
+        if self.dirty:
+            self._scan()
+            self.dirty = False
+        else:
+            self._refresh_pending()
+        now = time.monotonic()
+        ready = sorted(name for name, (_, _, changed) in self.pending.items() if now - changed >= self.settle_time)
+        for name in ready:
+            del self.pending[name]
+        return ready
+
+    def wait(self):
+        """阻塞到目录可能有变化，或有文件需要再次检查是否稳定"""
+        if self.inotify is not None:
+            timeout = self.settle_time if self.pending else None
+            if self.inotify.wait(timeout):
+                self.dirty = True
+            return
+        time.sleep(self.settle_time if self.pending else self.poll_interval)
+        if not self.dir_mtimes:
+            # 上次扫描时电子书目录不可用
+            self.dirty = True
+        for directory, mtime in self.dir_mtimes.items():
+            try:
+                changed = os.stat(directory).st_mtime_ns != mtime
+            except FileNotFoundError:
+                changed = True
+            if changed:
+                self.dirty = True
+                break
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+def watch_directory(config):
+    """无界面监视模式：持续监视电子书目录，新文件写完后成批发送（Ctrl+C 退出）"""
+    config = config or {}
+    ebooks_dir = config.get("ebooks_dir", DEFAULT_EBOOKS_DIR)
+    email_provider = config.get("email_provider", "Gmail")
+    email_username = config.get("email_username", "")
+    email_password = config.get("email_password", "")
+    kindle_email = config.get("kindle_email", "")
+    if not email_username or not email_password or not kindle_email:
+        print(MISSING_ACCOUNT_MESSAGE, file=sys.stderr)
+        return EXIT_USAGE
+    setup_directories(ebooks_dir)
+
+    journal = SendJournal()
+    batch = recover_interrupted_batch(journal)
+    if batch is not None and batch["remaining"]:
+        # 剩余文件仍在目录中，会被监视器重新发现
+        journal.end(batch["id"])
+
+    max_messages = config.get("max_messages_per_connection", DEFAULT_MAX_MESSAGES_PER_CONNECTION)
+    # 账号池在整个监视期间共用，熔断和限流状态跨批次保留
+    accounts = load_accounts(config, email_provider, email_username, email_password)
+    convert = get_convert_options(config)
+    watcher = DirectoryWatcher(ebooks_dir, convert=convert["enabled"])
+    index = FileIndex()
+    print(f"正在监视 {ebooks_dir}（按 Ctrl+C 退出）", flush=True)
+    logging.info(f"Watching {ebooks_dir} ({'inotify' if watcher.inotify else 'polling'}).")
+    try:
+        while True:
+            files = watcher.take_ready()
+            if files:
+                logging.info(f"Watch mode: sending {len(files)} new file(s).")
+                engine = SendEngine(files, ebooks_dir, email_provider, email_username, email_password, kindle_email,
+                                    max_messages=max_messages, index=index, journal=journal, accounts=accounts,
+                                    optimize=get_optimize_options(config), convert=convert)
+                result = run_headless(engine)
+                print(f"已发送 {result['sent']} 个，失败 {result['failed']} 个，跳过 {result['skipped']} 个。", flush=True)
+                if result["cancelled"]:
+                    return EXIT_CANCELLED
+                if not result["connected"]:
+                    # 连接失败时文件仍留在目录中，稍后重新扫描再试
+                    time.sleep(watcher.poll_interval)
+                    watcher.dirty = True
+            watcher.wait()
+    except KeyboardInterrupt:
+        return EXIT_OK
+    finally:
+        watcher.close()
+        index.close()
+
+def send_directory(config):
+    """无界面单次发送：发送电子书目录中的所有文件后退出，返回退出码（Ctrl+C 取消发送）"""
+    ebooks_dir = config.get("ebooks_dir", DEFAULT_EBOOKS_DIR)
+    email_provider = config.get("email_provider", "Gmail")
+    email_username = config.get("email_username", "")
+    email_password = config.get("email_password", "")
+    kindle_email = config.get("kindle_email", "")
+    if not email_username or not email_password or not kindle_email:
+        print(MISSING_ACCOUNT_MESSAGE, file=sys.stderr)
+        return EXIT_USAGE
+    if not os.path.isdir(ebooks_dir):
+        print(f"电子书目录不存在：{ebooks_dir}", file=sys.stderr)
+        return EXIT_USAGE
+
+    journal = SendJournal()
+    batch = recover_interrupted_batch(journal)
+    if batch is not None and batch["remaining"]:
+        # 剩余文件仍在目录中，下面的扫描会重新发送
+        journal.end(batch["id"])
+
+    convert = get_convert_options(config)
+    files = scan_ebooks(ebooks_dir, convert["enabled"])
+    if not files:
+        print("目录中没有找到可发送的文件。", flush=True)
+        return EXIT_OK
+    max_messages = config.get("max_messages_per_connection", DEFAULT_MAX_MESSAGES_PER_CONNECTION)
+    engine = SendEngine(files, ebooks_dir, email_provider, email_username, email_password, kindle_email,
+                        max_messages=max_messages, journal=journal,
+                        accounts=load_accounts(config, email_provider, email_username, email_password),
+                        optimize=get_optimize_options(config), convert=convert)
+    result = run_headless(engine)
+    if not result["connected"]:
+        return EXIT_CONNECTION_FAILED
+    print(f"已发送 {result['sent']} 个，失败 {result['failed']} 个，跳过 {result['skipped']} 个。", flush=True)
+    if result["cancelled"]:
+        return EXIT_CANCELLED
+    return EXIT_SEND_FAILED if result["failed"] else EXIT_OK
+
+# 事件日志中的各阶段：(阶段名, 事件类型, 耗时字段)
+EVENT_PHASES = [
+    ("scan", "scan", "seconds"),
+    ("validate", "validate", "seconds"),
+    ("convert", "convert", "seconds"),
+    ("optimize", "optimize", "seconds"),
+    ("connect", "connect", "connect_s"),
+    ("tls", "connect", "tls_s"),
+    ("auth", "connect", "auth_s"),
+    ("envelope", "message", "envelope_s"),
+    ("encode", "message", "encode_s"),
+    ("data", "message", "data_s"),
+    ("archive", "archive_index", "seconds"),
+    ("move", "move", "seconds"),
+]
+
+def read_events(path=EVENT_LOG_FILE):
+    """按时间顺序读取事件日志（包括轮转出去的旧文件），跳过无法解析的行"""
+    paths = [f"{path}.{n}" for n in range(LOG_BACKUP_COUNT, 0, -1)] + [path]
+    for log_path in paths:
+        if not os.path.exists(log_path):
+            continue
+        with open(log_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+def summarize_events(events, last_batch=False):
+    """汇总事件：各阶段的次数和耗时、批次总耗时、发送字节数、SMTP 回复码和错误类型的次数
+
+    last_batch 为 True 时只统计最后一个批次（上一批次结束之后的事件，包括发送前的扫描）。
+    """
+    events = list(events)
+    if last_batch:
+        ends = [n for n, event in enumerate(events) if event.get("event") == "batch_end"]
+        if len(ends) > 1:
+            events = events[ends[-2] + 1:]
+    phases = {name: [] for name, _, _ in EVENT_PHASES}
+    summary = {"phases": phases, "batches": 0, "batch_seconds": 0.0, "messages": 0, "bytes": 0,
+               "sent": 0, "failed": 0, "skipped": 0, "codes": {}, "errors": {}}
+    for event in events:
+        kind = event.get("event")
+        for name, event_kind, field in EVENT_PHASES:
+            if kind == event_kind and event.get(field) is not None:
+                phases[name].append(event[field])
+        if kind == "message":
+            code = str(event.get("code"))
+            summary["codes"][code] = summary["codes"].get(code, 0) + 1
+            if event.get("code") == 250:
+                summary["messages"] += 1
+                summary["bytes"] += event.get("bytes", 0)
+        elif kind in ("send_failed", "connect_failed"):
+            error = event.get("error_class") or event.get("error")
+            summary["errors"][error] = summary["errors"].get(error, 0) + 1
+            if event.get("code") is not None:
+                code = str(event["code"])
+                summary["codes"][code] = summary["codes"].get(code, 0) + 1
+        elif kind == "batch_end":
+            summary["batches"] += 1
+            summary["batch_seconds"] += event.get("seconds", 0)
+            for key in ("sent", "failed", "skipped"):
+                summary[key] += event.get(key, 0)
+    total = sum(sum(samples) for samples in phases.values())
+    summary["phases"] = {}
+    for name, samples in phases.items():
+        if not samples:
+            continue
+        ordered = sorted(samples)
+        summary["phases"][name] = {
+            "count": len(ordered),
+            "total_s": round(sum(ordered), 3),
+            "mean_ms": round(sum(ordered) / len(ordered) * 1000, 1),
+            "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1),
+            "share": round(sum(ordered) / total * 100, 1) if total else 0,
+        }
+    return summary
+
+def format_event_summary(summary):
+    """把 summarize_events 的结果排成表格文本；多个连接并行时各阶段合计会超过批次总耗时"""
+    lines = []
+    seconds = summary["batch_seconds"]
+    mb = summary["bytes"] / (1024 * 1024)
+    lines.append(f"批次：{summary['batches']}，总耗时 {seconds:.1f} 秒，发送 {summary['sent']} 个，失败 {summary['failed']} 个，"
+                 f"跳过 {summary['skipped']} 个")
+    lines.append(f"邮件：{summary['messages']} 封，{mb:.1f} MB" + (f"，平均 {mb / seconds:.2f} MB/s" if seconds else ""))
+    lines.append(f"{'阶段':<10}{'次数':>8}{'合计(秒)':>12}{'平均(毫秒)':>12}{'p95(毫秒)':>12}{'占比':>8}")
+    for name, phase in summary["phases"].items():
+        lines.append(f"{name:<10}{phase['count']:>8}{phase['total_s']:>12.2f}{phase['mean_ms']:>12.1f}"
+                     f"{phase['p95_ms']:>12.1f}{phase['share']:>7.1f}%")
+    if summary["codes"]:
+        lines.append("SMTP 回复码：" + "，".join(f"{code} ×{count}" for code, count in sorted(summary["codes"].items())))
+    if summary["errors"]:
+        lines.append("错误：" + "，".join(f"{error} ×{count}" for error, count in sorted(summary["errors"].items())))
+    return "\n".join(lines)
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        description="把电子书通过邮件发送到 Kindle。不带参数时打开图形界面。",
+        epilog=f"退出码：{EXIT_OK} 全部成功，{EXIT_SEND_FAILED} 部分文件发送失败，{EXIT_USAGE} 参数或配置错误，"
+               f"{EXIT_CONNECTION_FAILED} 无法连接或认证失败，{EXIT_CANCELLED} 发送中途被取消或停止。",
+    )
+    # 兼容旧的 --watch 参数
+    parser.add_argument("--watch", action="store_true", help=argparse.SUPPRESS)
+    subparsers = parser.add_subparsers(dest="command", metavar="{gui,send,watch,stats}")
+    subparsers.add_parser("gui", help="打开图形界面（默认）")
+    for name, help_text in (("send", "发送目录中的所有文件后退出"), ("watch", "持续监视目录，新文件写完后自动发送")):
+        command = subparsers.add_parser(name, help=help_text,
+                                        description=f"{help_text}。未指定的选项使用 config.json 中保存的值。")
+        command.add_argument("--dir", dest="ebooks_dir", help="电子书目录")
+        command.add_argument("--to", dest="kindle_email", help="Kindle 接收邮箱，多个用逗号分隔")
+        command.add_argument("--provider", dest="email_provider", choices=sorted(SMTP_SERVERS), help="邮箱提供商")
+        command.add_argument("--user", dest="email_username", help=f"发件邮箱（密码从 config.json 或环境变量 {PASSWORD_ENV_VAR} 读取）")
+        command.add_argument("--optimize", action="store_true", help="发送前压缩较大的 EPUB（每本书只压缩一次，结果会缓存）")
+        command.add_argument("--convert", action="store_true", help="发送前把 TXT、Markdown 和 HTML 文档转换为 EPUB（结果会缓存）")
+    stats = subparsers.add_parser("stats", help="汇总事件日志，查看发送时间花在哪些阶段")
+    stats.add_argument("--file", default=EVENT_LOG_FILE, help="事件日志文件")
+    stats.add_argument("--last", action="store_true", help="只统计最后一个批次")
+    stats.add_argument("--json", action="store_true", help="以 JSON 输出汇总结果")
+    return parser
+
+def merge_cli_options(config, args):
+    """用命令行参数覆盖 config.json 中的值；切换了发件账号时使用该账号保存的密码"""
+    config = dict(config or {})
+    for key in ("ebooks_dir", "kindle_email", "email_provider", "email_username"):
+        value = getattr(args, key, None)
+        if value:
+            config[key] = value
+    if getattr(args, "email_username", None) or getattr(args, "email_provider", None):
+        provider_prefix = "gmail" if config.get("email_provider", "Gmail") == "Gmail" else "qq"
+        saved_username = config.get(f"{provider_prefix}_username", "")
+        if not args.email_username:
+            config["email_username"] = saved_username
+        same_account = saved_username and config["email_username"] == saved_username
+        config["email_password"] = config.get(f"{provider_prefix}_password", "") if same_account else ""
+    if getattr(args, "optimize", False):
+        config["optimize_epub"] = dict(config.get("optimize_epub", {}), enabled=True)
+    if getattr(args, "convert", False):
+        config["convert_documents"] = dict(config.get("convert_documents", {}), enabled=True)
+    if os.environ.get(PASSWORD_ENV_VAR):
+        config["email_password"] = os.environ[PASSWORD_ENV_VAR]
+    config["email_password"] = clean_password(config.get("email_password", ""))
+    return config
 
 class KindleSenderApp:
     def __init__(self, root):
@@ -324,11 +3239,13 @@ class KindleSenderApp:
         self.email_password = tk.StringVar()
         self.kindle_email = tk.StringVar()
         self.progress = tk.DoubleVar()
+        self.progress_text = tk.StringVar(value="发送进度：")
         self.connection_status = tk.StringVar(value="未连接")
         self.email_provider = tk.StringVar(value="Gmail")
         self.email_history = []
         self.gmail_password = ""
         self.qq_password = ""
+        self.engine = None
 
         if self.config:
             self.ebooks_dir.set(self.config.get("ebooks_dir", DEFAULT_EBOOKS_DIR))
@@ -376,16 +3293,16 @@ class KindleSenderApp:
         tk.Label(self.root, text="提示：Gmail需使用应用专用密码（需启用两步验证）。QQ邮箱需使用授权码。", 
                  bg="#B0E0E6", fg="#191970", font=("微软雅黑", 14)).pack(pady=2)
 
-        tk.Label(self.root, text="提示：Gmail一次最多发送300个文件，QQ邮箱一次最多发送10个文件。", 
+        tk.Label(self.root, text="提示：超出邮箱发送额度的文件会自动排队，额度恢复后继续发送。", 
                  bg="#B0E0E6", fg="#191970", font=("微软雅黑", 14)).pack(pady=2)
 
-        tk.Label(self.root, text="Kindle邮箱：", bg="#B0E0E6", fg="#191970", font=("微软雅黑", 14)).pack(pady=2)
+        tk.Label(self.root, text="Kindle邮箱（多个用逗号分隔）：", bg="#B0E0E6", fg="#191970", font=("微软雅黑", 14)).pack(pady=2)
         ttk.Entry(self.root, textvariable=self.kindle_email, width=70).pack()
 
         tk.Label(self.root, text="连接状态：", bg="#B0E0E6", fg="#191970", font=("微软雅黑", 14)).pack(pady=2)
         tk.Label(self.root, textvariable=self.connection_status, bg="#B0E0E6", fg="#191970", font=("微软雅黑", 14, "italic")).pack()
 
-        tk.Label(self.root, text="发送进度：", bg="#B0E0E6", fg="#191970", font=("微软雅黑", 14)).pack(pady=2)
+        tk.Label(self.root, textvariable=self.progress_text, bg="#B0E0E6", fg="#191970", font=("微软雅黑", 14)).pack(pady=2)
         self.progress_bar = ttk.Progressbar(self.root, variable=self.progress, maximum=100, length=800, style="TProgressbar")
         self.progress_bar.pack()
 
@@ -395,6 +3312,12 @@ class KindleSenderApp:
         self.send_button = ttk.Button(button_frame, text="发送到Kindle", command=self.start_sending)
         self.send_button.pack(side=tk.LEFT, padx=15)
 
+        self.pause_button = ttk.Button(button_frame, text="暂停", command=self.toggle_pause, state=tk.DISABLED)
+        self.pause_button.pack(side=tk.LEFT, padx=15)
+
+        self.cancel_button = ttk.Button(button_frame, text="取消", command=self.cancel_sending, state=tk.DISABLED)
+        self.cancel_button.pack(side=tk.LEFT, padx=15)
+
         self.finish_button = ttk.Button(button_frame, text="完成", command=self.root.quit, state=tk.DISABLED)
         self.finish_button.pack(side=tk.LEFT, padx=15)
 
@@ -421,8 +3344,8 @@ class KindleSenderApp:
         self.send_button.config(state=tk.DISABLED)
         self.finish_button.config(state=tk.DISABLED)
         self.progress.set(0)
+        self.progress_text.set("发送进度：")
         self.connection_status.set("连接中...")
-        self.root.update()
 
         ebooks_dir = self.ebooks_dir.get()
         email_provider = self.email_provider.get()
@@ -430,34 +3353,12 @@ class KindleSenderApp:
         email_password = self.email_password.get()
         kindle_email = self.kindle_email.get()
 
-        if not ebooks_dir or not email_username or not email_password or not kindle_email:
+        if not ebooks_dir or not email_username or not email_password or not parse_recipients(kindle_email):
             messagebox.showerror("错误", "请填写所有字段！")
             self.connection_status.set("未连接")
             self.send_button.config(state=tk.NORMAL)
             return
 
-        files = [f for f in os.listdir(ebooks_dir) if f.lower().endswith(".epub")]
-        if not files:
-            messagebox.showinfo("提示", "目录中没有找到EPUB文件（仅支持 .epub 扩展名）。")
-            logging.info("No EPUB files found in the directory.")
-            self.send_button.config(state=tk.NORMAL)
-            self.finish_button.config(state=tk.NORMAL)
-            return
-
-        file_count = len(files)
-        max_files = 300 if email_provider == "Gmail" else 10
-
-        if email_provider == "Gmail" and file_count > max_files:
-            messagebox.showerror("错误", f"文件数量过多！Gmail一次最多发送{max_files}个文件，您有{file_count}个文件。")
-            self.connection_status.set("未连接")
-            self.send_button.config(state=tk.NORMAL)
-            return
-
-        if email_provider == "QQ" and file_count > max_files:
-            messagebox.showinfo("提示", "QQ邮箱一次最多发送10个文件，将发送前10个文件。")
-            files = files[:max_files]
-            file_count = len(files)
-
         config = {
             "ebooks_dir": ebooks_dir,
             "email_provider": email_provider,
@@ -467,47 +3368,104 @@ class KindleSenderApp:
         }
         try:
             save_config(config)
-        except Exception:
+        except Exception as e:
+            messagebox.showerror("错误", str(e) if isinstance(e, PermissionError) else f"无法保存配置：{e}")
             self.connection_status.set("未连接")
             self.send_button.config(state=tk.NORMAL)
             return
 
-        if not test_smtp_connection(email_provider, email_username, email_password):
-            self.connection_status.set("连接失败")
-            self.send_button.config(state=tk.NORMAL)
-            return
-        self.connection_status.set("连接成功")
-        self.root.update()
+        max_messages = (self.config or {}).get("max_messages_per_connection", DEFAULT_MAX_MESSAGES_PER_CONNECTION)
+        accounts = load_accounts(self.config, email_provider, email_username, email_password)
+        # 恢复中断的批次和扫描目录都在发送线程中进行，不阻塞界面
+        self.engine = SendEngine(None, ebooks_dir, email_provider, email_username, email_password, kindle_email,
+                                 max_messages=max_messages, accounts=accounts,
+                                 optimize=get_optimize_options(self.config), convert=get_convert_options(self.config))
+        self.pause_button.config(state=tk.NORMAL, text="暂停")
+        self.cancel_button.config(state=tk.NORMAL)
+        self.engine.start()
+        self.root.after(EVENT_POLL_INTERVAL_MS, self.poll_events)
 
-        sent_dir, failed_dir = setup_directories(ebooks_dir)
+    def poll_events(self):
+        """在 Tk 主线程中处理后台发送引擎的事件"""
+        while True:
+            try:
+                kind, data = self.engine.events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "status":
+                self.connection_status.set(data["text"])
+            elif kind == "progress":
+                self.progress.set(data["percent"])
+                self.progress_text.set(f"发送进度：{format_transfer(data)}")
+            elif kind == "error":
+                messagebox.showerror("错误", data["message"])
+            elif kind == "resume":
+                self.engine.answer_resume(messagebox.askyesno(
+                    "提示", f"检测到上次未完成的发送任务（剩余 {data['remaining']} 个文件），是否继续发送？"))
+            elif kind == "done":
+                self.on_sending_done(data)
+                return
+        self.root.after(EVENT_POLL_INTERVAL_MS, self.poll_events)
 
-        total_files = len(files)
-        for i, file in enumerate(files):
-            if file == os.path.basename(LOG_FILE):
-                continue
-            file_path = os.path.join(ebooks_dir, file)
-            file_size = os.path.getsize(file_path) / (1024 * 1024)
-            logging.info(f"Sending: {file}, Size: {file_size:.2f} MB")
-            success = False
-            for attempt in range(3):
-                if send_to_kindle(file_path, email_provider, email_username, email_password, kindle_email):
-                    success = True
-                    break
-                else:
-                    logging.warning(f"Failed to send {file} (attempt {attempt + 1}/3). Retrying...")
-                    time.sleep(30)
-            move_file(file_path, success, sent_dir, failed_dir)
-            self.progress.set((i + 1) / total_files * 100)
-            self.root.update()
-
-        messagebox.showinfo("成功", "处理完成！请检查“已发送至Kindle”和“发送失败”文件夹。")
+    def on_sending_done(self, data):
+        self.pause_button.config(state=tk.DISABLED, text="暂停")
+        self.cancel_button.config(state=tk.DISABLED)
         self.send_button.config(state=tk.NORMAL)
+        if not data["files"] and not data["cancelled"]:
+            messagebox.showinfo("提示", "目录中没有找到可发送的文件（支持 EPUB、PDF、DOC/DOCX、RTF、TXT、HTML 和图片）。")
+            logging.info("No supported files found in the directory.")
+            self.finish_button.config(state=tk.NORMAL)
+            return
+        if not data["connected"]:
+            return
+        if data["cancelled"]:
+            messagebox.showinfo("提示", f"发送已取消。已发送 {data['sent']} 个文件，失败 {data['failed']} 个。")
+        else:
+            message = "处理完成！请检查“已发送至Kindle”和“发送失败”文件夹。"
+            if data["skipped"]:
+                message += f"\n其中 {data['skipped']} 个文件此前已发送过，未重复发送。"
+            messagebox.showinfo("成功", message)
         self.finish_button.config(state=tk.NORMAL)
 
-def main():
-    root = tk.Tk()
-    app = KindleSenderApp(root)
-    root.mainloop()
+    def toggle_pause(self):
+        if self.engine is None:
+            return
+        if self.engine.paused:
+            self.engine.resume()
+            self.pause_button.config(text="暂停")
+        else:
+            self.engine.pause()
+            self.pause_button.config(text="继续")
+
+    def cancel_sending(self):
+        if self.engine is None:
+            return
+        self.engine.cancel()
+        self.pause_button.config(state=tk.DISABLED)
+        self.cancel_button.config(state=tk.DISABLED)
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    command = args.command or ("watch" if args.watch else "gui")
+    if command == "stats":
+        summary = summarize_events(read_events(args.file), last_batch=args.last)
+        print(json.dumps(summary, ensure_ascii=False, indent=2) if args.json else format_event_summary(summary))
+        return EXIT_OK
+    setup_logging()
+    if command == "gui":
+        import_tkinter()
+        root = tk.Tk()
+        app = KindleSenderApp(root)
+        root.mainloop()
+        return EXIT_OK
+    config = merge_cli_options(load_config(), args)
+    if command == "watch":
+        return watch_directory(config)
+    return send_directory(config)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if getattr(sys, "frozen", False):
+        # 打包成 exe 后 EPUB 压缩和文档转换的子进程需要
+        import multiprocessing
+        multiprocessing.freeze_support()
+    sys.exit(main())
\ No newline at end of file